@@ -6,128 +6,1885 @@ import indigoPluginUpdateChecker
 
 import os
 import sys
+import errno
 import socket
 import select
 import re
 import time
 import threading
-import Queue
-
-fan_queue = Queue.Queue(maxsize=1000)
-
+import collections
+import json
+import operator
+import bisect
+import struct
+import random
+
+MSG_WAKE = 0
 MSG_FAN = 1
 MSG_DEBUG = 2
 MSG_REINIT = 3
+MSG_IDENTITY = 4
+MSG_DISCOVERED = 5
+MSG_METRICS = 6
+MSG_COMMAND_FAILED = 7
+MSG_COMMAND_OK = 8
+
+# Maximum number of queued messages the dispatcher handles in one pass
+DISPATCH_BATCH = 250
+
+FAN_PORT = 31415
+
+# How long a non-blocking connect may take before it is abandoned
+CONNECT_TIMEOUT = 10
+
+# How long to wait for a fan to echo the state a command set before sending
+# it again. The wait doubles with each retry, and after ACK_RETRIES retries
+# the command is given up on.
+ACK_TIMEOUT = 2
+ACK_RETRIES = 3
+
+# Delay before reconnecting after a connection drops. The first retry comes
+# after RECONNECT_MIN_DELAY and the delay doubles with each failed attempt up
+# to RECONNECT_MAX_DELAY. Each delay is randomly cut by up to half so that
+# fans which dropped together don't all retry together.
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 60
+
+# When at least OUTAGE_FRACTION of the fans, and at least OUTAGE_MIN_FANS,
+# have lost their connections, it's more likely the network than the fans.
+# Only OUTAGE_PROBES of them keep trying. Each failed attempt hands the probe's
+# turn, and its backoff, to the fan held longest, so that fans which are really
+# switched off don't keep the others waiting but the retries still back off as
+# they would for a single fan. Once one gets through the rest are reconnected,
+# spread over OUTAGE_RELEASE_SPREAD seconds.
+OUTAGE_FRACTION = 0.5
+OUTAGE_MIN_FANS = 4
+OUTAGE_PROBES = 2
+OUTAGE_RELEASE_SPREAD = 2
+
+# Default number of heartbeats in a row a fan can leave unanswered before its
+# connection is treated as dead. Heartbeats are off unless an interval is set.
+HEARTBEAT_MISSES = 3
+
+# The TCP option for how long a connection sits idle before keepalive probes
+# start is TCP_KEEPIDLE on Linux and TCP_KEEPALIVE on macOS, which Python 2
+# doesn't export
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    TCP_KEEPIDLE = socket.TCP_KEEPIDLE
+elif sys.platform == 'darwin':
+    TCP_KEEPIDLE = getattr(socket, 'TCP_KEEPALIVE', 0x10)
+else:
+    TCP_KEEPIDLE = None
+
+# Default time in seconds during which repeated SETs of the same attribute on
+# a fan are collapsed into one
+COALESCE_WINDOW = 0.25
+
+# Most connection attempts the engine will have in progress at once
+MAX_CONNECTING = 16
+
+# How long after connecting a fan has to answer the DEVICE;ID query
+IDENTITY_TIMEOUT = 5
+
+# How long to wait for fans to answer a discovery broadcast, and the least
+# time between broadcasts the engine sends on its own after failed connects
+DISCOVERY_WINDOW = 2
+DISCOVERY_INTERVAL = 300
+
+# Upper bound on how long the engine sleeps in select() when nothing is due
+MAX_POLL_INTERVAL = 5
+
+# Largest message a fan is expected to send. Anything longer is treated as
+# garbage so that a misbehaving fan can't make a connection buffer grow
+# without bound.
+MAX_FRAME_SIZE = 1024
+
+# Most command data that may be waiting to be written to a fan. A connection
+# that falls this far behind is assumed to be dead.
+MAX_OUTBUF_SIZE = 8192
+
+POLL_READ = 1
+POLL_WRITE = 2
+
+# Capture files are rotated when they reach CAPTURE_FILE_SIZE bytes, keeping
+# CAPTURE_FILES of them per fan including the current one
+CAPTURE_FILE_SIZE = 1024 * 1024
+CAPTURE_FILES = 5
+
+# A capture file starts with CAPTURE_MAGIC and is followed by records, each a
+# CAPTURE_RECORD header (time, kind, length of data) and then the data.
+# CAPTURE_CONNECTED records mark a new connection to the fan, with data of
+# "1" if it replaces one that was lost. CAPTURE_RECEIVED records hold data as
+# read from the fan.
+CAPTURE_MAGIC = 'SMCAP1\n'
+CAPTURE_RECORD = struct.Struct('<dcI')
+CAPTURE_CONNECTED = 'C'
+CAPTURE_RECEIVED = 'R'
+
+# How often the engine asks the dispatcher to sample the metrics, and the
+# default interval at which they are published to Indigo variables
+METRICS_INTERVAL = 10
+METRICS_PUBLISH_INTERVAL = 60
+
+# Where published metrics go. Each variable is named the prefix followed by
+# the name of the metric.
+METRICS_FOLDER = "SenseME"
+METRICS_VARIABLE_PREFIX = "SenseME_"
+
+# Histogram bucket boundaries for latencies in milliseconds, for queue
+# depths and for message rates in messages per second
+LATENCY_BUCKETS = [ 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000 ]
+DEPTH_BUCKETS = [ 0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000 ]
+RATE_BUCKETS = [ 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100 ]
+
+# How much debugging output is produced. At DEBUG_HISTORY the recent debug
+# messages for each fan are kept in memory, DEBUG_LOG also writes them to the
+# Indigo log.
+DEBUG_OFF = 0
+DEBUG_HISTORY = 1
+DEBUG_LOG = 2
+
+# Number of recent debug messages kept for each fan
+DEBUG_HISTORY_SIZE = 200
+
+# Most debug messages that may be waiting for the dispatcher. Past this they
+# are dropped rather than delaying anything else.
+MAX_QUEUED_DEBUG = 1000
+
+# Most fan messages that may be waiting for the dispatcher in arrival order.
+# Past this, new ones only keep their latest value, like state messages.
+MAX_QUEUED_EVENTS = 1000
 
 ################################################################################
-# Create a thread that just establishes a TCP connection with a fan. Any
-# data received by the fan is added to the main threads queue so that the
-# main thread can process it.
-class FanListener(threading.Thread):
-    def __init__(self, q, devID, fanIP, timeoutMinutes, fanID):
-        threading.Thread.__init__(self)
-        self.q = q
-        self.fanIP = fanIP
+# The queue between the fan engine and the dispatcher. State changes and other
+# messages that affect devices go in a high priority lane that is always
+# emptied first; debug chatter goes in a bounded low priority lane and is
+# dropped, and counted, when the dispatcher falls behind. put() never blocks
+# so a slow dispatcher can't stop the engine from reading its sockets.
+#
+# Fan messages are put with a key naming the attribute they report. Most
+# only matter for their latest value: while one is waiting for the
+# dispatcher, a newer message from the same device with the same key replaces
+# it in place. Ordered messages, such as motion events, are all kept in
+# order, up to maxEvents of them, after which they are collapsed the same
+# way. A backed up queue therefore holds a bounded number of messages per
+# device and key no matter how much traffic the fans send.
+#
+# A message is never moved ahead of a MSG_REINIT for its device. Each
+# MSG_REINIT starts a new generation for the device, and messages only
+# replace ones from the same generation.
+class FanQueue(object):
+    def __init__(self, maxDebug = MAX_QUEUED_DEBUG, maxEvents = MAX_QUEUED_EVENTS):
+        self.maxDebug = maxDebug
+        self.maxEvents = maxEvents
+        # The high lane holds (key, msg) pairs. For keyed messages msg is
+        # None and the message itself is kept in latest.
+        self.high = collections.deque()
+        self.latest = {}
+        # devID -> generation, bumped by each MSG_REINIT
+        self.generations = {}
+        self.events = 0
+        self.low = collections.deque()
+        self.dropped = 0
+        self.droppedEvents = 0
+        self.superseded = 0
+        self.ready = threading.Condition(threading.Lock())
+
+    # Returns False if the message was dropped
+    def put(self, msg, key = None, ordered = False):
+        with self.ready:
+            if msg[0] == MSG_DEBUG:
+                if len(self.low) >= self.maxDebug:
+                    self.dropped += 1
+                    return False
+                self.low.append(msg)
+            elif key != None and (not ordered or self.events >= self.maxEvents):
+                # Too far behind to keep every event, keep the latest one
+                # rather than losing it or growing further
+                self.__putLatest((msg[1], self.generations.get(msg[1], 0), key), msg)
+            elif msg[0] == MSG_FAN and self.events >= self.maxEvents:
+                # Nothing to collapse this message into
+                self.droppedEvents += 1
+                return False
+            else:
+                if msg[0] == MSG_FAN:
+                    self.events += 1
+                elif msg[0] == MSG_REINIT:
+                    self.generations[msg[1]] = self.generations.get(msg[1], 0) + 1
+                self.high.append((None, msg))
+
+            self.ready.notify()
+        return True
+
+    def __putLatest(self, key, msg):
+        if key in self.latest:
+            self.superseded += 1
+        else:
+            self.high.append((key, None))
+        self.latest[key] = msg
+
+    # Waits for at least one message and returns up to maxItems of them, high
+    # priority messages first
+    def getBatch(self, maxItems):
+        with self.ready:
+            while not self.high and not self.low:
+                self.ready.wait()
+
+            batch = []
+            while self.high and len(batch) < maxItems:
+                key, msg = self.high.popleft()
+                if key != None:
+                    msg = self.latest.pop(key)
+                elif msg[0] == MSG_FAN:
+                    self.events -= 1
+                batch.append(msg)
+
+            while self.low and len(batch) < maxItems:
+                batch.append(self.low.popleft())
+
+        return batch
+
+    # Number of messages waiting for the dispatcher
+    def depth(self):
+        return len(self.high) + len(self.low)
+
+    # Returns the number of debug messages and of fan messages dropped since
+    # the last call
+    def takeDropped(self):
+        with self.ready:
+            dropped = ( self.dropped, self.droppedEvents )
+            self.dropped = 0
+            self.droppedEvents = 0
+        return dropped
+
+fan_queue = FanQueue()
+
+################################################################################
+# Splits the stream of data received from a fan into individual "(...)"
+# messages. Data is scanned once per feed() and only an incomplete message at
+# the end is kept for next time. Anything that isn't part of a well formed
+# message, including a message interrupted by the start of another one, is
+# skipped and counted in discarded.
+class FrameDecoder(object):
+    def __init__(self, maxFrame = MAX_FRAME_SIZE):
+        self.maxFrame = maxFrame
+        self.partial = ''
+        self.discarded = 0
+
+    def reset(self):
+        self.partial = ''
+
+    def feed(self, data):
+        if self.partial:
+            data = self.partial + data
+            self.partial = ''
+
+        frames = []
+        pos = 0
+        n = len(data)
+
+        while pos < n:
+            end = data.find(')', pos)
+            if end < 0:
+                break
+
+            # The frame starts at the last '(' before the ')'. Any earlier
+            # '(' belongs to a message that was cut short.
+            start = data.rfind('(', pos, end)
+            if start < 0:
+                self.discarded += end + 1 - pos
+            else:
+                self.discarded += start - pos
+                if end + 1 - start > self.maxFrame:
+                    self.discarded += end + 1 - start
+                else:
+                    frames.append(data[start:end + 1])
+
+            pos = end + 1
+
+        if pos < n:
+            start = data.rfind('(', pos)
+            if start < 0:
+                self.discarded += n - pos
+            else:
+                self.discarded += start - pos
+                if n - start > self.maxFrame:
+                    self.discarded += n - start
+                else:
+                    self.partial = data[start:]
+
+        return frames
+
+################################################################################
+# The engine can multiplex its sockets with any of the mechanisms the platform
+# offers. They all present the same small interface: register, modify and
+# unregister a file descriptor, and poll() for a list of (fd, events) pairs.
+# Errors and hangups are reported as both readable and writable so that the
+# engine notices them whether the socket is connecting or connected.
+class SelectPoller(object):
+    name = 'select'
+
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+
+    def modify(self, fd, events):
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        self.fds.pop(fd, None)
+
+    def poll(self, timeout):
+        readers = [ fd for fd, ev in self.fds.items() if ev & POLL_READ ]
+        writers = [ fd for fd, ev in self.fds.items() if ev & POLL_WRITE ]
+
+        ready = select.select(readers, writers, [], timeout)
+
+        events = {}
+        for fd in ready[0]:
+            events[fd] = POLL_READ
+        for fd in ready[1]:
+            events[fd] = events.get(fd, 0) | POLL_WRITE
+        return events.items()
+
+class PollPoller(object):
+    name = 'poll'
+
+    def __init__(self):
+        self.poller = select.poll()
+        self.readMask = select.POLLIN | select.POLLPRI
+        self.writeMask = select.POLLOUT
+        self.errorMask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def __mask(self, events):
+        mask = 0
+        if events & POLL_READ:
+            mask |= self.readMask
+        if events & POLL_WRITE:
+            mask |= self.writeMask
+        return mask
+
+    def register(self, fd, events):
+        self.poller.register(fd, self.__mask(events))
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, self.__mask(events))
+
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except (KeyError, IOError, OSError):
+            pass
+
+    def _wait(self, timeout):
+        # poll() wants milliseconds
+        return self.poller.poll(int(timeout * 1000))
+
+    def poll(self, timeout):
+        events = []
+        for fd, mask in self._wait(timeout):
+            ev = 0
+            if mask & (self.readMask | self.errorMask):
+                ev |= POLL_READ
+            if mask & (self.writeMask | self.errorMask):
+                ev |= POLL_WRITE
+            events.append((fd, ev))
+        return events
+
+class EpollPoller(PollPoller):
+    name = 'epoll'
+
+    def __init__(self):
+        self.poller = select.epoll()
+        self.readMask = select.EPOLLIN | select.EPOLLPRI
+        self.writeMask = select.EPOLLOUT
+        self.errorMask = select.EPOLLERR | select.EPOLLHUP
+
+    def _wait(self, timeout):
+        return self.poller.poll(timeout)
+
+class KqueuePoller(object):
+    name = 'kqueue'
+
+    def __init__(self):
+        self.kq = select.kqueue()
+        self.fds = {}
+
+    def __control(self, fd, filter, flags):
+        try:
+            self.kq.control([ select.kevent(fd, filter=filter, flags=flags) ], 0)
+        except (IOError, OSError):
+            pass
+
+    def register(self, fd, events):
+        self.fds[fd] = 0
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        old = self.fds.get(fd, 0)
+        for flag, filter in ((POLL_READ, select.KQ_FILTER_READ), (POLL_WRITE, select.KQ_FILTER_WRITE)):
+            if events & flag and not old & flag:
+                self.__control(fd, filter, select.KQ_EV_ADD)
+            elif old & flag and not events & flag:
+                self.__control(fd, filter, select.KQ_EV_DELETE)
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        self.modify(fd, 0)
+        self.fds.pop(fd, None)
+
+    def poll(self, timeout):
+        events = {}
+        for kev in self.kq.control(None, max(1, len(self.fds) * 2), timeout):
+            if kev.filter == select.KQ_FILTER_READ:
+                ev = POLL_READ
+            else:
+                ev = POLL_WRITE
+            if kev.flags & (select.KQ_EV_EOF | select.KQ_EV_ERROR):
+                ev = POLL_READ | POLL_WRITE
+            events[kev.ident] = events.get(kev.ident, 0) | ev
+        return events.items()
+
+# In order of preference when the backend is set to 'auto'
+POLLERS = [ KqueuePoller, EpollPoller, PollPoller, SelectPoller ]
+
+# Returns the poller for the requested backend, falling back to the best one
+# available on this platform if the requested one isn't supported here.
+def makePoller(backend):
+    available = [ cls for cls in POLLERS if hasattr(select, cls.name) ]
+    for cls in available:
+        if cls.name == backend:
+            return cls()
+    return available[0]()
+
+################################################################################
+# The state the engine keeps for each fan it is connected to.
+class FanConnection(object):
+    def __init__(self, devID, fanIP, timeoutMinutes, fanName, fanID):
         self.devID = devID
-        self.sock = None
+        self.fanIP = fanIP
         self.timeoutMinutes = timeoutMinutes
+        self.fanName = encodeMessage(fanName)
+        self.fanID = encodeMessage(fanID) or self.fanName
+        self.identityDeadline = 0
+        self.verifyingID = False
+        self.sock = None
+        self.fd = -1
+        self.connecting = False
+        self.connectStarted = 0
+        self.reinit = False
+        self.retryAt = 0
+        # Set once the fan has been connected to at all
+        self.wasConnected = False
+        # Connection attempts in a row that failed or delivered nothing
+        self.failures = 0
+        self.receivedAtConnect = 0
         self.tick = 0
+        self.decoder = FrameDecoder()
+        self.outbuf = ''
+        self.events = 0
+        # key -> [ time last sent, message waiting to be sent or None ]
+        self.coalesce = {}
+        self.coalesceAt = 0
+        self.superseded = 0
+        # Counters for the metrics
+        self.received = 0
+        self.sent = 0
+        self.reconnects = 0
+        self.discarded = 0
+        # FanCapture while traffic is being captured
+        self.capture = None
+        # Commands waiting for the fan to echo the state they set, keyed by
+        # the start of the echo, e.g. FAN;SPD for FAN;SPD;SET;3. Each is
+        # [ message, time first sent, time last sent, retries, deadline ].
+        self.awaiting = {}
+        self.ackAt = 0
+        self.commandFailed = False
+        self.retries = 0
+        self.commandFailures = 0
+        # Command round trip times in milliseconds
+        self.rtt = Histogram(LATENCY_BUCKETS)
+        # When anything was last received, when the outstanding heartbeat was
+        # sent (0 if there isn't one) and how many in a row went unanswered
+        self.heard = 0
+        self.heartbeatSent = 0
+        self.heartbeatMissed = 0
+        self.heartbeatFailures = 0
+        # Heartbeat round trip times in milliseconds
+        self.heartbeatRtt = Histogram(LATENCY_BUCKETS)
+
+################################################################################
+# A single thread that owns the TCP connection to every fan. All of the fan
+# sockets are multiplexed with one poller so the number of threads and wakeups
+# stays the same no matter how many fans are configured. Any data received
+# from a fan is added to the main threads queue so that the main thread can
+# process it.
+#
+# Fans are connected to in parallel, up to MAX_CONNECTING at a time. If the
+# fan's MAC address was cached from an earlier run it is used straight away.
+# Otherwise, or if the fan doesn't answer to the cached address, the engine
+# asks the fan for its identity along with its state, and until the fan
+# answers it is addressed by name.
+#
+# Other threads never touch the sockets directly. They ask the engine to do
+# something by queueing a call and writing to a wakeup pipe, and the engine
+# runs the call from its own thread.
+#
+# Commands for a fan are written over its TCP connection. A UDP datagram is
+# only sent when the fan isn't currently connected.
+#
+# With heartbeats enabled, a fan that has sent nothing for heartbeatInterval
+# seconds is asked for its occupancy status, a cheap GET that every fan
+# answers. A fan that leaves heartbeatMisses of them in a row unanswered is
+# treated as disconnected, which finds a dead connection in seconds rather
+# than waiting on the minutes long inactivity timeout or TCP keepalive.
+#
+# A fan whose connection drops is reconnected quickly at first, then with
+# exponential backoff and jitter. If most fans drop at once, only a few are
+# left probing until one gets through, so that a network outage doesn't turn
+# into every fan retrying in lockstep.
+#
+# The same UDP socket is used to discover fans. A DEVICE;ID query is
+# broadcast to every fan on the network and each reply is passed to the main
+# thread as a MSG_DISCOVERED message. The engine does this by itself when a
+# connection attempt fails, in case the fan's IP address has changed.
+#
+# Commands that set a level, such as the fan speed, can be sent with a
+# coalesce key. The first one goes out straight away, but any more for the
+# same key within the coalescing window are held back and only the latest is
+# sent when the window ends, so a slider sweep doesn't queue up every value
+# along the way on the fan.
+class FanEngine(threading.Thread):
+    def __init__(self, q, backend = 'auto'):
+        threading.Thread.__init__(self)
+        self.q = q
+        self.fans = {}
+        self.socks = {}
+        self.calls = collections.deque()
+        self.debugLevel = DEBUG_OFF
         self.stoprequest = threading.Event()
-        self.fanID = fanID
-        self.leftover = ''
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.poller = makePoller(backend)
+        self.poller.register(self.wakeRead, POLL_READ)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.udp.setblocking(0)
+        self.poller.register(self.udp.fileno(), POLL_READ)
+        self.lastDiscovery = 0
+        self.coalesceWindow = COALESCE_WINDOW
+        self.superseded = 0
+        # Commands sent to fans the engine has no connection for
+        self.datagrams = 0
+        self.metricsAt = time.time() + METRICS_INTERVAL
+        self.captureDir = None
+        self.commandRtt = Histogram(LATENCY_BUCKETS)
+        self.heartbeatInterval = 0
+        self.heartbeatMisses = HEARTBEAT_MISSES
+        self.heartbeatRtt = Histogram(LATENCY_BUCKETS)
+        self.random = random.Random()
+        # When __runTimers next needs to run. Wakeups before then for data
+        # from the fans don't go over every fan.
+        self.timersDue = 0
+        self.outage = False
+        # No new outage is declared before this, to give the fans released at
+        # the end of the last one time to reconnect
+        self.outageHoldoff = 0
+        # devIDs of the fans still trying to connect during an outage
+        self.probes = set()
+
+    ########################################
+    # Methods that may be called from any thread
+    def addFan(self, devID, fanIP, timeoutMinutes, fanName, fanID = None):
+        self.__call(self.__addFan, FanConnection(devID, fanIP, timeoutMinutes, fanName, fanID))
+
+    # Called once the fan's MAC address is known
+    def setFanID(self, devID, fanID):
+        self.__call(self.__setFanID, devID, fanID)
+
+    def removeFan(self, devID):
+        self.__call(self.__removeFan, devID)
+
+    def discover(self):
+        self.__call(self.__discover)
+
+    # Start capturing the data received from each fan into files in
+    # directory, or stop if directory is None
+    def setCapture(self, directory):
+        self.__call(self.__setCapture, directory)
 
-    def __connect_to_fan(self, reinit):
-        if reinit == True:
-            time.sleep(3)
+    # fanIP is only used if the fan isn't being managed by the engine
+    def sendCommand(self, devID, fanIP, msg, coalesceKey = None):
+        self.__call(self.__sendCommand, devID, fanIP, msg, coalesceKey)
 
-        if self.sock == None:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Sends [ ( devID, fanIP, msg, coalesceKey ) ] in one pass of the engine,
+    # so the first and last fans get their commands as close together as
+    # possible
+    def sendCommands(self, commands):
+        if commands:
+            self.__call(self.__sendCommands, commands)
 
-            # Enable keepalive
-            TCP_KEEPALIVE = 0x10
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            self.sock.setsockopt(socket.IPPROTO_TCP, TCP_KEEPALIVE, 60)
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        self.__wakeup()
+        super(FanEngine, self).join(timeout)
 
-        self.q.put((MSG_DEBUG, self.devID, "Thread connecting to " + self.fanIP))
+    def __call(self, fn, *args):
+        self.calls.append((fn, args))
+        self.__wakeup()
 
+    def __wakeup(self):
         try:
-            self.sock.connect((self.fanIP, 31415))
-            self.tick = int(time.time())
+            os.write(self.wakeWrite, 'x')
+        except OSError:
+            pass
 
-        except socket.error as e:
-            msg = "Bind to %s failed. Error %s : %s" % (self.fanIP, str(e[0]), e[1])
-            self.q.put((MSG_DEBUG, self.devID, msg))
-            self.sock.close()
-            self.sock = None
-            return
+    ########################################
+    # Everything below here only runs on the engine thread
+    def __debug(self, conn, msg, *args):
+        self.__debugDevice(conn.devID, msg, *args)
+
+    # Formatting is left to the dispatcher, and nothing is queued at all
+    # unless debugging is enabled. devID is None for messages that aren't
+    # about any one fan.
+    def __debugDevice(self, devID, msg, *args):
+        if self.debugLevel != DEBUG_OFF:
+            self.q.put((MSG_DEBUG, devID, (time.time(), msg, args)))
+
+    # A failure while handling one fan must never take down the engine and with
+    # it every other fan, so anything unexpected just resets that connection.
+    # Returns whatever fn returns, or None if it failed.
+    def __safely(self, conn, fn, *args):
+        try:
+            return fn(conn, *args)
+        except Exception as e:
+            self.__debug(conn, "%s engine error: %s", conn.fanIP, e)
+            try:
+                self.__disconnected(conn)
+            except Exception as e:
+                # Whatever is left to send is what failed, so drop it
+                conn.outbuf = ''
+                self.__debug(conn, "%s engine error while resetting: %s", conn.fanIP, e)
+
+    # The connection is started by the next pass through __runTimers
+    def __addFan(self, conn):
+        self.fans[conn.devID] = conn
+        self.__startCapture(conn)
+
+    def __setFanID(self, devID, fanID):
+        conn = self.fans.get(devID)
+        if conn != None:
+            conn.fanID = encodeMessage(fanID)
+            conn.identityDeadline = 0
+            conn.verifyingID = False
+
+    def __removeFan(self, devID):
+        conn = self.fans.pop(devID, None)
+        if conn != None:
+            self.__close(conn)
+            self.__stopCapture(conn)
+            self.__debug(conn, "Connection closed")
+
+    def __setCapture(self, directory):
+        self.captureDir = directory
+        for conn in self.fans.values():
+            self.__stopCapture(conn)
+            self.__startCapture(conn)
+
+    def __startCapture(self, conn):
+        if self.captureDir != None:
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', conn.fanName)
+            conn.capture = FanCapture(os.path.join(self.captureDir, "%s-%d.cap" % ( name, conn.devID )))
+
+    def __stopCapture(self, conn):
+        if conn.capture != None:
+            conn.capture.close()
+            conn.capture = None
+
+    # Failing to capture is reported but doesn't otherwise affect the fan
+    def __capture(self, conn, kind, data):
+        try:
+            conn.capture.write(kind, data)
+        except (IOError, OSError) as e:
+            self.__debug(conn, "Stopped capturing traffic: %s", e)
+            self.__stopCapture(conn)
+
+    # Makes sure __runTimers runs by when
+    def __timerAt(self, when):
+        if when < self.timersDue:
+            self.timersDue = when
 
-        if reinit == True:
-            self.q.put((MSG_REINIT, self.devID, ""))
+    def __connect(self, conn):
+        if conn.reinit:
+            conn.reconnects += 1
+        self.__timerAt(time.time() + CONNECT_TIMEOUT)
 
-        self.sock.setblocking(0)
+        conn.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # Enable keepalive
+        conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if TCP_KEEPIDLE != None:
+            conn.sock.setsockopt(socket.IPPROTO_TCP, TCP_KEEPIDLE, 60)
+
+        conn.sock.setblocking(0)
+        conn.fd = conn.sock.fileno()
+        self.socks[conn.fd] = conn
+        conn.events = POLL_WRITE
+        self.poller.register(conn.fd, conn.events)
+
+        self.__debug(conn, "Engine connecting to %s", conn.fanIP)
+
+        try:
+            err = conn.sock.connect_ex((conn.fanIP, FAN_PORT))
+        except socket.error as e:
+            err = e[0]
+
+        if err in (0, errno.EISCONN):
+            self.__connected(conn)
+        elif err in (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK):
+            conn.connecting = True
+            conn.connectStarted = time.time()
+        else:
+            self.__connectFailed(conn, err)
+
+    def __connected(self, conn):
+        # The identity, heartbeat and inactivity timers all start now
+        self.__timerAt(0)
+        conn.connecting = False
+        conn.wasConnected = True
+        conn.receivedAtConnect = conn.received
+        conn.tick = int(time.time())
+        conn.heard = time.time()
+        conn.heartbeatSent = 0
+        conn.heartbeatMissed = 0
+        conn.decoder.reset()
+        self.__setEvents(conn, POLL_READ)
+
+        if conn.capture != None:
+            self.__capture(conn, CAPTURE_CONNECTED, '1' if conn.reinit else '')
+
+        if conn.reinit == True:
+            self.q.put((MSG_REINIT, conn.devID, ""))
+
+        if self.outage and conn.devID in self.probes:
+            self.__endOutage(time.time())
+
+        self.__bootstrap(conn)
+
+    def __bootstrap(self, conn):
+        conn.identityDeadline = time.time() + IDENTITY_TIMEOUT
+
+        if conn.fanID == conn.fanName:
+            # Learn the fan's MAC address. The reply is handled by the main
+            # thread, which passes the address back with setFanID.
+            msg = "<%s;DEVICE;ID;GET>" % ( conn.fanName )
+            self.__write(conn, msg)
+        else:
+            # The GETALL below is addressed to the cached MAC address, so a
+            # reply to it confirms the address is still right
+            conn.verifyingID = True
 
         # Send a GETALL to the newly connected fan to learn al about it
-        msg = "<%s;GETALL>" % ( self.fanID )
-        self.sock.send(msg)
+        msg = "<%s;GETALL>" % ( conn.fanID )
+        self.__write(conn, msg)
 
         # GETALL apparently doesn't return the status of the motion detector, so also request
         # the motion detector status
-        msg = "<%s;SNSROCC;STATUS;GET>" % ( self.fanID )
-        self.sock.send(msg)
+        msg = "<%s;SNSROCC;STATUS;GET>" % ( conn.fanID )
+        self.__write(conn, msg)
+
+    # Stops addressing the fan by its cached MAC address, which may be stale,
+    # and asks it for its identity again
+    def __reidentify(self, conn):
+        conn.verifyingID = False
+        conn.fanID = conn.fanName
+        self.q.put((MSG_IDENTITY, conn.devID, ""))
+        self.__bootstrap(conn)
+
+    # Whether the fan is addressed by its cached MAC address and that address
+    # isn't already being checked
+    def __addressedByMAC(self, conn):
+        return conn.fanID != conn.fanName and not conn.verifyingID
+
+    def __connectFailed(self, conn, err):
+        self.__debug(conn, "Bind to %s failed. Error %s : %s", conn.fanIP, err, os.strerror(err))
+        self.__close(conn)
+        conn.failures += 1
+        delay = self.__scheduleReconnect(conn)
+        self.__debug(conn, "Connection failed. Retrying in %.1f seconds.", delay)
+
+        if self.outage and conn.devID in self.probes:
+            self.__passProbe(conn)
+
+        # The fan may just have a new address
+        if time.time() - self.lastDiscovery >= DISCOVERY_INTERVAL:
+            self.__discover()
+
+    # A connection that closed without delivering anything counts as a failed
+    # attempt, so a fan that accepts connections and drops them straight away
+    # is backed off too
+    def __disconnected(self, conn):
+        if conn.received == conn.receivedAtConnect:
+            conn.failures += 1
+        self.__close(conn)
+        self.__scheduleReconnect(conn)
+
+    # Returns the delay chosen
+    def __scheduleReconnect(self, conn):
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * (2 ** min(conn.failures, 16)))
+        delay = self.random.uniform(delay / 2, delay)
+        conn.reinit = True
+        conn.retryAt = time.time() + delay
+        self.__timerAt(conn.retryAt)
+        return delay
+
+    # Works out whether enough fans have lost their connections to treat it
+    # as an outage, and which fans should keep trying if so. A fan that has
+    # never connected doesn't count, so that starting up isn't an outage.
+    def __checkOutage(self, now):
+        lost = [ conn for conn in self.fans.values() if conn.wasConnected and (conn.sock == None or conn.connecting) ]
+        outage = len(lost) >= OUTAGE_MIN_FANS and len(lost) >= len(self.fans) * OUTAGE_FRACTION
+
+        if outage and not self.outage:
+            if now < self.outageHoldoff:
+                return
+            self.__debugDevice(None, "%d of %d fans unreachable, only probing %d of them", len(lost), len(self.fans), OUTAGE_PROBES)
+        elif self.outage and not outage:
+            self.__endOutage(now)
+            return
 
-    def run(self):
-        self.__connect_to_fan(False)
+        self.outage = outage
+        if outage:
+            # Fill any places left by probes that are no longer lost
+            lostIDs = set(conn.devID for conn in lost)
+            self.probes &= lostIDs
+            for conn in sorted(lost, key = lambda conn: conn.retryAt):
+                if len(self.probes) >= OUTAGE_PROBES:
+                    break
+                self.probes.add(conn.devID)
+
+    # Gives the failed probe's turn to the fan that has been held longest. The
+    # next probe carries on from the failed one's backoff, so the fans together
+    # retry no faster than one fan would.
+    def __passProbe(self, conn):
+        held = [ other for other in self.fans.values()
+                 if other.wasConnected and other.sock == None and other.devID not in self.probes ]
+        if not held:
+            return
+        nextProbe = min(held, key = lambda other: other.retryAt)
+        nextProbe.failures = conn.failures
+        nextProbe.retryAt = conn.retryAt
+        self.probes.discard(conn.devID)
+        self.probes.add(nextProbe.devID)
+
+    def __endOutage(self, now):
+        self.__debugDevice(None, "Fans reachable again, reconnecting the rest")
+        for conn in self.fans.values():
+            if conn.sock == None and conn.devID not in self.probes:
+                conn.failures = 0
+                conn.retryAt = now + self.random.uniform(0, OUTAGE_RELEASE_SPREAD)
+        self.outage = False
+        self.outageHoldoff = now + OUTAGE_RELEASE_SPREAD + CONNECT_TIMEOUT
+        self.__timerAt(now)
+        self.probes.clear()
+
+    def __close(self, conn):
+        if conn.sock != None:
+            self.poller.unregister(conn.fd)
+            self.socks.pop(conn.fd, None)
+            conn.sock.close()
+            conn.sock = None
+        conn.connecting = False
+        conn.events = 0
+        conn.identityDeadline = 0
+        conn.verifyingID = False
+
+        # Anything that didn't make it out over TCP still gets a chance by UDP
+        if conn.outbuf:
+            outbuf = conn.outbuf
+            conn.outbuf = ''
+            self.__sendDatagram(conn.devID, conn.fanIP, outbuf)
+
+    def __setEvents(self, conn, events):
+        if conn.events != events:
+            conn.events = events
+            self.poller.modify(conn.fd, events)
+
+    def __sendCommand(self, devID, fanIP, msg, coalesceKey):
+        msg = encodeMessage(msg)
+        conn = self.fans.get(devID)
+        if conn == None:
+            # Commands for fans the engine manages are counted in conn.sent
+            self.datagrams += 1
+            self.__sendDatagram(devID, fanIP, msg)
+            return
+
+        if coalesceKey != None and self.coalesceWindow > 0:
+            self.__coalesce(conn, msg, coalesceKey)
+            return
+
+        # Anything being held back was requested before this command, so it
+        # has to go out first
+        self.__sendCoalesced(conn, True)
+        self.__transmit(conn, msg)
+
+    def __sendCommands(self, commands):
+        for devID, fanIP, msg, coalesceKey in commands:
+            self.__sendCommand(devID, fanIP, msg, coalesceKey)
+
+    def __transmit(self, conn, msg):
+        conn.sent += 1
+
+        prefix = commandEchoPrefix(msg)
+        if prefix != None:
+            now = time.time()
+            deadline = now + ACK_TIMEOUT
+            conn.awaiting[prefix] = [ msg, now, now, 0, deadline ]
+            if conn.ackAt == 0 or deadline < conn.ackAt:
+                conn.ackAt = deadline
+            self.__timerAt(deadline)
+
+        self.__send(conn, msg)
 
+    def __send(self, conn, msg):
+        if conn.sock != None and not conn.connecting:
+            self.__safely(conn, self.__write, msg)
+        else:
+            self.__sendDatagram(conn.devID, conn.fanIP, msg)
+
+    # Called for each message from a fan while commands are waiting for their
+    # echo. The round trip is timed from the last time the command was sent.
+    def __checkEcho(self, conn, frame, now):
+        path = frame[frame.find(';') + 1:]
+        for prefix, entry in conn.awaiting.items():
+            if path.startswith(prefix + ';'):
+                del conn.awaiting[prefix]
+                rtt = (now - entry[2]) * 1000
+                conn.rtt.add(rtt)
+                self.commandRtt.add(rtt)
+                if conn.commandFailed:
+                    conn.commandFailed = False
+                    self.q.put((MSG_COMMAND_OK, conn.devID, ""))
+
+    # Resend commands whose echo is overdue, backing off each time, and give up
+    # on those that have been retried too often
+    def __checkAcks(self, conn, now):
+        conn.ackAt = 0
+        failed = False
+
+        for prefix, entry in conn.awaiting.items():
+            msg, firstSent, lastSent, retries, deadline = entry
+            if now >= deadline:
+                if retries >= ACK_RETRIES:
+                    del conn.awaiting[prefix]
+                    conn.commandFailures += 1
+                    self.__debug(conn, "%s never confirmed %s", conn.fanIP, msg)
+                    failed = True
+                    if not conn.commandFailed:
+                        conn.commandFailed = True
+                        self.q.put((MSG_COMMAND_FAILED, conn.devID, msg))
+                    continue
+
+                retries += 1
+                conn.retries += 1
+                deadline = now + ACK_TIMEOUT * (2 ** retries)
+                conn.awaiting[prefix] = [ msg, firstSent, now, retries, deadline ]
+                self.__debug(conn, "%s didn't confirm %s, retry %d", conn.fanIP, msg, retries)
+                self.__send(conn, msg)
+
+            if conn.ackAt == 0 or deadline < conn.ackAt:
+                conn.ackAt = deadline
+
+        # The fan may be ignoring commands sent to an address it no longer has.
+        # A fan that isn't connected has its address checked on reconnecting.
+        if failed and conn.sock != None and not conn.connecting and self.__addressedByMAC(conn):
+            self.__debug(conn, "%s stopped confirming commands sent to '%s'. Asking for its identity.", conn.fanIP, conn.fanID)
+            self.__safely(conn, self.__reidentify)
+
+    def __heartbeat(self, conn, now):
+        conn.heartbeatSent = now
+        self.__write(conn, "<%s;SNSROCC;STATUS;GET>" % ( conn.fanID ))
+
+    def __heartbeatAnswered(self, conn, now):
+        rtt = (now - conn.heartbeatSent) * 1000
+        conn.heartbeatRtt.add(rtt)
+        self.heartbeatRtt.add(rtt)
+        conn.heartbeatSent = 0
+        conn.heartbeatMissed = 0
+
+    # Sends a heartbeat if the fan has been quiet for too long, and counts the
+    # last one as missed if nothing at all has been heard since it was sent.
+    # Returns when this next needs to run.
+    def __checkHeartbeat(self, conn, now):
+        interval = self.heartbeatInterval
+
+        if conn.heartbeatSent:
+            deadline = conn.heartbeatSent + interval
+            if now < deadline:
+                return deadline
+            if conn.heard >= conn.heartbeatSent:
+                # The fan is alive, the answer is just slow or lost
+                conn.heartbeatSent = 0
+                conn.heartbeatMissed = 0
+            else:
+                conn.heartbeatMissed += 1
+                if conn.heartbeatMissed >= self.heartbeatMisses:
+                    self.__debug(conn, "%s missed %d heartbeats. Reinitializing connection.", conn.fanIP, conn.heartbeatMissed)
+                    conn.heartbeatFailures += 1
+                    self.__disconnected(conn)
+                    return 0
+                self.__heartbeat(conn, now)
+                return now + interval
+
+        idle = conn.heard + interval
+        if now < idle:
+            return idle
+        self.__heartbeat(conn, now)
+        return now + interval
+
+    def __coalesce(self, conn, msg, key):
+        now = time.time()
+        entry = conn.coalesce.get(key)
+
+        if entry == None or (entry[1] == None and now - entry[0] >= self.coalesceWindow):
+            conn.coalesce[key] = [ now, None ]
+            self.__transmit(conn, msg)
+            return
+
+        if entry[1] != None:
+            conn.superseded += 1
+            self.superseded += 1
+        entry[1] = msg
+
+        sendAt = entry[0] + self.coalesceWindow
+        if conn.coalesceAt == 0 or sendAt < conn.coalesceAt:
+            conn.coalesceAt = sendAt
+        self.__timerAt(sendAt)
+
+    # Send whatever is being held back whose window has ended, or everything
+    # if force is set
+    def __sendCoalesced(self, conn, force = False):
+        if conn.coalesceAt == 0:
+            return
+
+        now = time.time()
+        conn.coalesceAt = 0
+
+        for key, entry in conn.coalesce.items():
+            if entry[1] == None:
+                if now - entry[0] >= self.coalesceWindow:
+                    del conn.coalesce[key]
+            elif force or now >= entry[0] + self.coalesceWindow:
+                msg = entry[1]
+                conn.coalesce[key] = [ now, None ]
+                self.__transmit(conn, msg)
+            else:
+                sendAt = entry[0] + self.coalesceWindow
+                if conn.coalesceAt == 0 or sendAt < conn.coalesceAt:
+                    conn.coalesceAt = sendAt
+
+    def __discover(self):
+        self.lastDiscovery = time.time()
+        try:
+            self.udp.sendto("<ALL;DEVICE;ID;GET>", ('<broadcast>', FAN_PORT))
+        except socket.error as e:
+            self.__debugDevice(None, "Discovery broadcast failed: %s", e)
+
+    def __readDatagrams(self):
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(2048)
+            except socket.error as e:
+                if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self.__debugDevice(None, "UDP receive failed: %s", e)
+                return
+
+            # Replies look like (name;DEVICE;ID;MAC;model)
+            for frame in FrameDecoder().feed(data):
+                params = frame[1:-1].split(';')
+                if len(params) >= 4 and params[1] == 'DEVICE' and params[2] == 'ID':
+                    self.q.put((MSG_DISCOVERED, None, (params[0], params[3], addr[0])))
+
+    # Never raises, as it's the last resort for anything that couldn't be sent
+    # over TCP
+    def __sendDatagram(self, devID, fanIP, msg):
+        try:
+            self.udp.sendto(encodeMessage(msg), (fanIP, FAN_PORT))
+        except Exception as e:
+            self.__debugDevice(devID, "UDP send to %s failed: %s", fanIP, e)
+
+    def __write(self, conn, msg):
+        if len(conn.outbuf) + len(msg) > MAX_OUTBUF_SIZE:
+            self.__debug(conn, "%s isn't accepting commands. Reinitializing connection.", conn.fanIP)
+            self.__disconnected(conn)
+            self.__sendDatagram(conn.devID, conn.fanIP, msg)
+            return
+
+        conn.outbuf += msg
+        self.__flush(conn)
+
+    def __flush(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error as e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                sent = 0
+            else:
+                self.__debug(conn, "%s socket error %s : %s", conn.fanIP, e[0], e[1])
+                self.__disconnected(conn)
+                return
+
+        conn.outbuf = conn.outbuf[sent:]
+
+        # Only ask to be told when the socket is writable while there is
+        # something waiting to be written
+        if conn.outbuf:
+            self.__setEvents(conn, POLL_READ | POLL_WRITE)
+        else:
+            self.__setEvents(conn, POLL_READ)
+
+    def __read(self, conn):
+        try:
+            data = conn.sock.recv(2048)
+        except socket.error as e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.__debug(conn, "%s socket error %s : %s", conn.fanIP, e[0], e[1])
+            self.__disconnected(conn)
+            return
+
+        if not data:
+            self.__debug(conn, "%s closed the connection", conn.fanIP)
+            self.__disconnected(conn)
+            return
+
+        now = time.time()
+        conn.tick = int(now)
+        conn.heard = now
+
+        if conn.capture != None:
+            self.__capture(conn, CAPTURE_RECEIVED, data)
+
+        # The data received may have multiple parenthesized data points. Put
+        # each complete one onto the queue, along with when it arrived.
+        for frame in conn.decoder.feed(data):
+            rejected = 'ERROR' in frame[1:-1].split(';')[:2]
+            if conn.verifyingID and not rejected:
+                conn.verifyingID = False
+                conn.identityDeadline = 0
+            elif rejected and conn.sock != None and self.__addressedByMAC(conn):
+                self.__debug(conn, "%s rejected a command sent to '%s'. Asking for its identity.", conn.fanIP, conn.fanID)
+                self.__reidentify(conn)
+            conn.received += 1
+            conn.failures = 0
+            if conn.awaiting:
+                self.__checkEcho(conn, frame, now)
+            if conn.heartbeatSent and frame.find(';SNSROCC;STATUS;') > 0:
+                self.__heartbeatAnswered(conn, now)
+            key, ordered = fanMessageKey(frame)
+            self.q.put((MSG_FAN, conn.devID, (frame, now)), key, ordered)
+
+        if conn.decoder.discarded:
+            self.__debug(conn, "discarded %d bytes of malformed data", conn.decoder.discarded)
+            conn.discarded += conn.decoder.discarded
+            conn.decoder.discarded = 0
+
+    def __checkConnecting(self, conn):
+        err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err == 0:
+            self.__connected(conn)
+        else:
+            self.__connectFailed(conn, err)
+
+    # Start any reconnects that are due and drop connections that have timed
+    # out, and work out when this next needs to run. Anything that sets an
+    # earlier deadline in between calls __timerAt.
+    def __runTimers(self):
+        now = time.time()
+        due = now + MAX_POLL_INTERVAL
+        self.timersDue = due
+
+        if now >= self.metricsAt:
+            self.q.put((MSG_METRICS, None, now))
+            self.metricsAt = now + METRICS_INTERVAL
+        due = min(due, self.metricsAt)
+
+        connecting = len([ conn for conn in self.fans.values() if conn.connecting ])
+
+        self.__checkOutage(now)
+
+        for conn in self.fans.values():
+            if conn.ackAt:
+                if now >= conn.ackAt:
+                    self.__checkAcks(conn, now)
+                if conn.ackAt:
+                    due = min(due, conn.ackAt)
+
+            if conn.coalesceAt:
+                if now >= conn.coalesceAt:
+                    self.__sendCoalesced(conn)
+                if conn.coalesceAt:
+                    due = min(due, conn.coalesceAt)
+
+            if conn.sock == None:
+                if self.outage and conn.wasConnected and conn.devID not in self.probes:
+                    # Held until a probe gets through
+                    continue
+                if now < conn.retryAt:
+                    due = min(due, conn.retryAt)
+                elif connecting < MAX_CONNECTING:
+                    self.__safely(conn, self.__connect)
+                    if conn.connecting:
+                        connecting += 1
+                continue
+
+            if conn.identityDeadline and now >= conn.identityDeadline and conn.verifyingID:
+                self.__debug(conn, "%s didn't answer to '%s'. Asking for its identity.", conn.fanIP, conn.fanID)
+                self.__safely(conn, self.__reidentify)
+                if conn.identityDeadline:
+                    due = min(due, conn.identityDeadline)
+            elif conn.identityDeadline and now >= conn.identityDeadline:
+                self.__debug(conn, "%s didn't report its identity. Addressing it as '%s'.", conn.fanIP, conn.fanID)
+                conn.identityDeadline = 0
+            elif conn.identityDeadline:
+                due = min(due, conn.identityDeadline)
+
+            if conn.connecting:
+                deadline = conn.connectStarted + CONNECT_TIMEOUT
+                if now >= deadline:
+                    self.__connectFailed(conn, errno.ETIMEDOUT)
+                else:
+                    due = min(due, deadline)
+                continue
+
+            if self.heartbeatInterval > 0:
+                deadline = self.__safely(conn, self.__checkHeartbeat, now)
+                if conn.sock == None:
+                    continue
+                due = min(due, deadline)
+
+            if conn.timeoutMinutes > 0:
+                deadline = conn.tick + (conn.timeoutMinutes * 60)
+                if now > deadline:
+                    self.__debug(conn, "No messages from fan in %d minutes. Reinitializing connection.", conn.timeoutMinutes)
+                    self.__disconnected(conn)
+                else:
+                    due = min(due, deadline)
+
+        self.__timerAt(due)
+
+    def run(self):
         while not self.stoprequest.isSet():
+            # A bad request must not take the engine, and every fan, down
+            while self.calls:
+                fn, args = self.calls.popleft()
+                try:
+                    fn(*args)
+                except Exception as e:
+                    self.__debugDevice(None, "engine error in %s: %s", fn.__name__, e)
+                # Requests such as adding a fan can start timers of their own
+                self.timersDue = 0
+
+            if time.time() >= self.timersDue:
+                self.__runTimers()
+            timeout = max(0, self.timersDue - time.time())
+
             try:
-                while self.sock == None:
-                    self.__connect_to_fan(True)
-                    if self.sock == None:
-                        self.q.put((MSG_DEBUG, self.devID, "Connection failed. Sleeping for 60 seconds."))
-                        time.sleep(60)
-
-                ready = select.select([self.sock], [], [], 5)
-                if ready[0]:
-                    data = self.sock.recv(2048)
-                    self.tick = int(time.time())
-
-                    data = self.leftover + data
-                    self.leftover = ''
-
-                    # The data received may have multiple parenthesized data points. Split them
-                    # and put each individual message onto the queue
-                    # Convert "(msg1)(msg2)(msg3)" to "(msg1)|(msg2)|(msg3)" then split on the '|'
-                    for p in data.replace(')(', ')|(').split('|'):
-                        if p[-1] != ')':
-                            self.leftover = p
-                            msg = "saving for next select: '%s'" % ( p )
-                            self.q.put((MSG_DEBUG, self.devID, msg))
-                        else:
-                            self.q.put((MSG_FAN, self.devID, p))
+                ready = self.poller.poll(timeout)
+            except (select.error, IOError, OSError) as e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
 
-            except socket.error as e:
-                msg = "%s socket error %s : %s" % (self.fanIP, str(e[0]), e[1])
-                self.q.put((MSG_DEBUG, self.devID, msg))
-                self.sock.close()
-                self.sock = None
-            except Exception as e:
-                msg = "%s generic error %s : %s" % (self.fanIP, str(e[0]), e[1])
-                self.q.put((MSG_DEBUG, self.devID, msg))
+            for fd, events in ready:
+                if fd == self.wakeRead:
+                    os.read(self.wakeRead, 4096)
+                    continue
 
-            if self.timeoutMinutes > 0 and int(time.time()) - self.tick > (self.timeoutMinutes * 60 ):
-                self.q.put((MSG_DEBUG, self.devID, "No messages from fan in %d minutes. Reinitializing connection." % ( self.timeoutMinutes)))
-                self.sock.close()
-                self.sock = None
+                if fd == self.udp.fileno():
+                    self.__readDatagrams()
+                    continue
 
-        if self.sock != None:
-            self.sock.close()
+                # A connection may have been closed by an earlier event in
+                # this same batch
+                conn = self.socks.get(fd)
+                if conn == None:
+                    continue
 
-        self.q.put((MSG_DEBUG, self.devID, "Terminating thread"))
+                if conn.connecting:
+                    if events & POLL_WRITE:
+                        self.__safely(conn, self.__checkConnecting)
+                    continue
 
-    def join(self, timeout=None):
-        self.stoprequest.set()
-        super(FanListener, self).join(timeout)
+                if events & POLL_READ:
+                    self.__safely(conn, self.__read)
+                if events & POLL_WRITE and conn.sock != None and conn.outbuf:
+                    self.__safely(conn, self.__flush)
+
+        for conn in self.fans.values():
+            self.__close(conn)
+            self.__stopCapture(conn)
+            self.__debug(conn, "Terminating engine")
+
+        self.udp.close()
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+
+
+################################################################################
+# Fan names come from Indigo as unicode, but everything sent to a fan has to be
+# bytes
+def encodeMessage(msg):
+    if isinstance(msg, unicode):
+        return msg.encode('utf-8')
+    return msg
+
+################################################################################
+# Formats a debug message as unicode. Messages from the engine carry the bytes
+# sent to and received from the fans, which can't be mixed with the unicode
+# fan names as they are.
+def formatDebugMsg(msg, args):
+    if args:
+        args = tuple(arg.decode('utf-8', 'replace') if isinstance(arg, str) else arg for arg in args)
+        msg = msg % args
+    if isinstance(msg, str):
+        msg = msg.decode('utf-8', 'replace')
+    return msg
+
+################################################################################
+# Returns the start of the message a fan sends back to confirm a command, such
+# as FAN;SPD for <name;FAN;SPD;SET;3> or LIGHT;PWR for <name;LIGHT;PWR;ON>, or
+# None for commands that don't set anything
+def commandEchoPrefix(msg):
+    start = msg.find('<')
+    end = msg.find('>', start + 1)
+    if start < 0 or end < 0:
+        return None
+
+    params = msg[start + 1:end].split(';')[1:]
+    if 'SET' in params:
+        params = params[:params.index('SET')]
+    elif len(params) >= 2 and params[-1] in ('ON', 'OFF'):
+        params = params[:-1]
+    else:
+        return None
+
+    if not params:
+        return None
+    return ';'.join(params)
 
+################################################################################
+# Appends the traffic from one fan to a capture file, rotating it once it gets
+# too big. The file is only opened when there's something to write, and each
+# record is flushed straight away so that nothing is lost if the plugin dies.
+class FanCapture(object):
+    def __init__(self, path, maxSize = CAPTURE_FILE_SIZE, keep = CAPTURE_FILES):
+        self.path = path
+        self.maxSize = maxSize
+        self.keep = keep
+        self.f = None
+        self.size = 0
+
+    def write(self, kind, data = ''):
+        if self.f == None:
+            self.f = open(self.path, 'ab')
+            self.size = self.f.tell()
+            if self.size == 0:
+                self.f.write(CAPTURE_MAGIC)
+                self.size = len(CAPTURE_MAGIC)
+
+        self.f.write(CAPTURE_RECORD.pack(time.time(), kind, len(data)) + data)
+        self.f.flush()
+        self.size += CAPTURE_RECORD.size + len(data)
+
+        if self.size >= self.maxSize:
+            self.rotate()
+
+    # path becomes path.1, path.1 becomes path.2 and so on, and the oldest
+    # is dropped
+    def rotate(self):
+        self.close()
+        for i in range(self.keep - 1, 0, -1):
+            older = "%s.%d" % ( self.path, i )
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % ( self.path, i + 1 ))
+        if os.path.exists(self.path):
+            os.rename(self.path, self.path + '.1')
+        oldest = "%s.%d" % ( self.path, self.keep )
+        if os.path.exists(oldest):
+            os.remove(oldest)
+
+    def close(self):
+        if self.f != None:
+            self.f.close()
+            self.f = None
+
+# Returns the capture file path and those rotated out of it, oldest first
+def captureFiles(path):
+    files = []
+    i = 1
+    while os.path.exists("%s.%d" % ( path, i )):
+        files.insert(0, "%s.%d" % ( path, i ))
+        i += 1
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+# Yields ( time, kind, data ) for each record in a capture file. A record cut
+# short, as when the plugin stopped part way through writing it, ends the file.
+def readCapture(path):
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s isn't a capture file" % ( path ))
+
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            when, kind, length = CAPTURE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield ( when, kind, data )
+
+################################################################################
+# Every fan that has answered a discovery broadcast, keyed by MAC address. The
+# inventory is saved to disk so that it's available as soon as the plugin
+# starts, before any fan has been heard from.
+class FanInventory(object):
+    def __init__(self, path):
+        self.path = path
+        self.fans = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                fans = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        with self.lock:
+            self.fans = dict((fan['mac'], fan) for fan in fans)
+
+    def save(self):
+        with self.lock:
+            fans = self.fans.values()
+
+        # Write a new file and move it into place so a crash can't leave a
+        # half written inventory behind
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(fans, f, indent = 1)
+        os.rename(tmp, self.path)
+
+    # Returns True if this is a new fan or anything about it has changed
+    def update(self, name, mac, ip):
+        with self.lock:
+            fan = self.fans.get(mac)
+            changed = fan == None or fan['name'] != name or fan['ip'] != ip
+            self.fans[mac] = { 'name' : name, 'mac' : mac, 'ip' : ip, 'seen' : int(time.time()) }
+        return changed
+
+    def byName(self, name):
+        with self.lock:
+            for fan in self.fans.values():
+                if fan['name'] == name:
+                    return fan
+        return None
+
+    def byMAC(self, mac):
+        with self.lock:
+            return self.fans.get(mac)
+
+    def all(self):
+        with self.lock:
+            return sorted(self.fans.values(), key = lambda fan: fan['name'])
+
+################################################################################
+# A histogram with fixed bucket boundaries, cheap enough to update for every
+# message. Percentiles are estimated as the upper bound of the bucket they
+# fall in.
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [ 0 ] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        remaining = self.count * p / 100.0
+        for i, n in enumerate(self.counts):
+            remaining -= n
+            if remaining <= 0:
+                break
+        if i < len(self.bounds):
+            return min(self.bounds[i], self.max)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return float(self.total) / self.count
+
+    def summary(self):
+        return "count %d, mean %.1f, p50 %.1f, p95 %.1f, p99 %.1f, max %.1f" % ( self.count, self.mean(), self.percentile(50), self.percentile(95), self.percentile(99), self.max )
+
+################################################################################
+# Runtime metrics gathered by the dispatcher. The engine keeps its own
+# counters on each FanConnection, which are read from here when sampling.
+class PluginMetrics(object):
+    def __init__(self):
+        self.started = time.time()
+        # Time from a fan message arriving on the socket to its state being
+        # sent to the server, in milliseconds
+        self.latency = Histogram(LATENCY_BUCKETS)
+        # Messages waiting when the dispatcher takes a batch
+        self.queueDepth = Histogram(DEPTH_BUCKETS)
+        # Messages per second received from each fan, sampled every
+        # METRICS_INTERVAL
+        self.fanRate = Histogram(RATE_BUCKETS)
+        self.debugDropped = 0
+        self.eventsDropped = 0
+        # devID -> count
+        self.parseFailures = collections.Counter()
+        self.commands = collections.Counter()
+        # devID -> messages per second at the last sample
+        self.rates = {}
+        # devID -> ( time, messages received ) at the last sample
+        self.lastSample = {}
+
+    # Work out each fan's message rate since the previous sample
+    def sample(self, now, conns):
+        for conn in conns:
+            last = self.lastSample.get(conn.devID)
+            self.lastSample[conn.devID] = ( now, conn.received )
+            if last != None and now > last[0]:
+                rate = (conn.received - last[1]) / (now - last[0])
+                self.rates[conn.devID] = rate
+                self.fanRate.add(rate)
+
+    def forget(self, devID):
+        for counts in [ self.parseFailures, self.commands, self.rates, self.lastSample ]:
+            counts.pop(devID, None)
+
+################################################################################
+# Everything the plugin tracks about a fan's state, along with the label
+# debugState shows it under. FanState's fields are generated from this list.
+FAN_STATE_SCHEMA = [
+    ( 'light',            'light' ),
+    ( 'fan',              'fan' ),
+    ( 'light_level',      'light level' ),
+    ( 'fan_level',        'fan level' ),
+    ( 'light_auto',       'light auto' ),
+    ( 'fan_auto',         'fan auto' ),
+    ( 'smartmode',        'smart mode' ),
+    ( 'motion',           'motion' ),
+    ( 'whoosh',           'whoosh' ),
+    ( 'beep',             'beep' ),
+    ( 'indicators',       'indicators' ),
+    ( 'direction',        'direction' ),
+    ( 'coolingIdealTemp', 'cooling temp' ),
+    ( 'sleepIdealTemp',   'sleep temp' ),
+    ( 'sleepMode',        'sleep mode' ),
+]
+
+################################################################################
+# The last known state of a fan, plus what the plugin needs to keep alongside
+# it. Values are kept in their natural type (ints for levels, bools for power)
+# and are None until the fan reports them.
+class FanState(object):
+    FIELDS = tuple(field for field, label in FAN_STATE_SCHEMA)
+
+    __slots__ = FIELDS + ( 'dev', 'MAC', 'statusString', 'stateImage', 'pending', 'history', 'resync', 'groups' )
+
+    __values = operator.attrgetter(*FIELDS)
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.MAC = dev.pluginProps.get('fanMAC', '')
+        self.stateImage = None
+        self.pending = {}
+        # Recent debug messages as (time, format, args)
+        self.history = collections.deque(maxlen = DEBUG_HISTORY_SIZE)
+        # Snapshot of the state when the fan reconnected, until the fan has
+        # reported everything again
+        self.resync = None
+        # FanGroups the fan belongs to
+        self.groups = []
+        self.reset()
+
+    # Forget everything the fan has reported
+    def reset(self):
+        for field in FanState.FIELDS:
+            setattr(self, field, None)
+        self.statusString = None
+
+    def snapshot(self):
+        return FanState.__values(self)
+
+    # Returns the fields whose value differs from the snapshot
+    def diff(self, snapshot):
+        return [ field for field, old, new in zip(FanState.FIELDS, snapshot, FanState.__values(self)) if old != new ]
+
+################################################################################
+# A group of fans that are controlled together. Its state summarizes its
+# members and is kept up to date from each change a member reports, rather
+# than by going over every member, so a large group costs no more to keep
+# current than a small one.
+class FanGroup(object):
+    # The member fields the group's state depends on
+    FIELDS = ( 'fan', 'light', 'fan_level', 'light_level' )
+
+    def __init__(self, dev, members):
+        self.dev = dev
+        self.members = members
+        self.fansOn = 0
+        self.lightsOn = 0
+        # level -> number of members reporting it
+        self.speeds = collections.Counter()
+        self.brightness = collections.Counter()
+        # The state values last sent to the server
+        self.states = {}
+        self.stateImage = None
+        self.dirty = True
+
+    def add(self, fan):
+        for field in FanGroup.FIELDS:
+            self.update(field, None, getattr(fan, field))
+
+    def remove(self, fan):
+        for field in FanGroup.FIELDS:
+            self.update(field, getattr(fan, field), None)
+
+    # Called whenever a member's field changes from old to new
+    def update(self, field, old, new):
+        if field == 'fan':
+            self.fansOn += (new == True) - (old == True)
+        elif field == 'light':
+            self.lightsOn += (new == True) - (old == True)
+        elif field == 'fan_level':
+            countLevel(self.speeds, old, new)
+        elif field == 'light_level':
+            countLevel(self.brightness, old, new)
+        else:
+            return
+        self.dirty = True
+
+    # Returns [ ( state, value ) ] for the group as it stands
+    def summary(self):
+        total = len(self.members)
+        fanStatus = groupStatus(self.fansOn, total)
+        lightStatus = groupStatus(self.lightsOn, total)
+
+        s = "%s / %s" % ( groupStatusText(fanStatus, self.fansOn, total),
+                          groupStatusText(lightStatus, self.lightsOn, total) )
+        if len(self.speeds) > 1:
+            s += " (mixed speeds)"
+
+        return [
+            ( 'fansOn',          self.fansOn ),
+            ( 'lightsOn',        self.lightsOn ),
+            ( 'fanStatus',       fanStatus ),
+            ( 'lightStatus',     lightStatus ),
+            ( 'speed',           max(self.speeds) if self.speeds else 0 ),
+            ( 'speedMixed',      len(self.speeds) > 1 ),
+            ( 'brightness',      max(self.brightness) if self.brightness else 0 ),
+            ( 'brightnessMixed', len(self.brightness) > 1 ),
+            ( 'statusString',    s ),
+        ]
+
+def countLevel(counts, old, new):
+    if old != None:
+        counts[old] -= 1
+        if counts[old] <= 0:
+            del counts[old]
+    if new != None:
+        counts[new] += 1
+
+def groupStatus(on, total):
+    if on == 0:
+        return 'allOff'
+    if on >= total:
+        return 'allOn'
+    return 'someOn'
+
+def groupStatusText(status, on, total):
+    if status == 'someOn':
+        return "%d of %d on" % ( on, total )
+    return 'on' if status == 'allOn' else 'off'
+
+# Returns the devIDs of the fans chosen in a group's config
+def groupMembers(props):
+    members = []
+    for devID in props.get('members', []):
+        try:
+            members.append(int(devID))
+        except ValueError:
+            pass
+    return members
+
+################################################################################
+# Returns the state image for a fan, or group of fans, at the given speed
+def fanStateImage(level):
+    if level == 0:
+        return indigo.kStateImageSel.FanOff
+    elif level in [ 1, 2 ]:
+        return indigo.kStateImageSel.FanLow
+    elif level in [ 3, 4 ]:
+        return indigo.kStateImageSel.FanMedium
+    elif level in [ 5, 6, 7 ]:
+        return indigo.kStateImageSel.FanHigh
+    return indigo.kStateImageSel.Error
+
+################################################################################
+# Conversions from the raw value in a fan message to the value kept in the
+# FanState
+def parseOn(raw):
+    return raw == 'ON'
+
+def parseOccupied(raw):
+    return raw == 'OCCUPIED'
+
+def parseDirection(raw): # FWD or REV
+    if raw == 'FWD':
+        return "forward"
+    elif raw == 'REV':
+        return "reverse"
+    return "unknown"
+
+# Conversions from the value in the FanState to the value of the Indigo state.
+# Each returns a (value, uiValue) tuple, with a uiValue of None if Indigo
+# should display the value as is.
+def stateValue(dev, value):
+    return (value, None)
+
+def temperatureValue(dev, value):
+    tempUnits = dev.pluginProps['fanTempUnits']
+    if tempUnits == 'C':
+        temp = str(value / 100)
+    else:
+        # Divide by 100, then F = C * 9/5 + 32
+        temp = str(float((value / 100) * 9 ) / 5 + 32)
+
+    return (temp, "%s %s" % ( temp, tempUnits ))
+
+# Only trigger events once the initial value of a state is known
+TRIGGER_CHANGE = 1
+# Always trigger events, including for the initial value
+TRIGGER_ALWAYS = 2
+
+################################################################################
+# Describes one type of message received from a fan. path is the part of the
+# message following the fan name, field is where the value is kept in the
+# FanState, state is the Indigo state it updates and index is the position of
+# the value within the message. Messages that need more than a state update
+# name a Plugin method as their handler instead, which is called with the fan
+# and the raw value.
+class FanMessage(object):
+    def __init__(self, path, field, state, index, label, parse = str, convert = stateValue, trigger = TRIGGER_CHANGE, handler = None):
+        self.path = path
+        self.field = field
+        self.state = state
+        self.index = index
+        self.label = label
+        self.parse = parse
+        self.convert = convert
+        self.trigger = trigger
+        self.handler = handler
+
+FAN_MESSAGES = dict((m.path, m) for m in [
+    FanMessage('LIGHT;LEVEL;ACTUAL',   'light_level',      'brightness',       4, 'light level', int),
+    FanMessage('FAN;SPD;ACTUAL',       'fan_level',        'speed',            4, 'fan speed', int),
+    FanMessage('FAN;AUTO',             'fan_auto',         'fan_motion',       3, 'fan motion'),
+    FanMessage('LIGHT;AUTO',           'light_auto',       'light_motion',     3, 'light motion'),
+    FanMessage('LIGHT;PWR',            'light',            'light',            3, 'light', parseOn, trigger = TRIGGER_ALWAYS),
+    FanMessage('FAN;PWR',              'fan',              'fan',              3, 'fan', parseOn),
+    FanMessage('DEVICE;ID',            'MAC',              None,               3, 'MAC', handler = 'updateFanID'),
+    FanMessage('SMARTMODE;ACTUAL',     'smartmode',        'smartmode',        3, 'smartmode'),
+    FanMessage('SNSROCC;STATUS',       'motion',           'motion',           3, 'motion', parseOccupied, trigger = TRIGGER_ALWAYS),
+    FanMessage('FAN;WHOOSH;STATUS',    'whoosh',           'whoosh',           4, 'whoosh'),
+    FanMessage('DEVICE;BEEPER',        'beep',             'beep',             3, 'beep'),
+    FanMessage('DEVICE;INDICATORS',    'indicators',       'indicators',       3, 'indicators'),
+    FanMessage('FAN;DIR',              'direction',        'direction',        3, 'direction', parseDirection),
+    FanMessage('LEARN;ZEROTEMP',       'coolingIdealTemp', 'coolingIdealTemp', 3, 'cooling ideal temperature', int, temperatureValue),
+    FanMessage('SMARTSLEEP;IDEALTEMP', 'sleepIdealTemp',   'sleepIdealTemp',   3, 'sleep ideal temperature', int, temperatureValue),
+    FanMessage('SLEEP;STATE',          'sleepMode',        'sleepMode',        3, 'sleep mode'),
+])
+
+# Returns the FanMessage describing a message split into its parameters, or
+# None if it isn't one the plugin handles
+def findFanMessage(params):
+    msg = FAN_MESSAGES.get(';'.join(params[1:4]))
+    if msg == None:
+        msg = FAN_MESSAGES.get(';'.join(params[1:3]))
+    return msg
+
+# Returns the key FanQueue coalesces a fan message under, and whether every
+# copy of it matters. Messages that always trigger events, or that need a
+# handler, are kept in order.
+def fanMessageKey(data):
+    msg = findFanMessage(data[1:-1].split(';'))
+    if msg == None:
+        return (None, True)
+    return (msg.path, msg.trigger != TRIGGER_CHANGE or msg.handler != None)
+
+################################################################################
+# The attributes that can be set by the batchCommands action. Each is the
+# command sent with the value filled in, the coalesce key, and the action type
+# and field whose rules in validateActionConfigUi the value must pass. The
+# value of an ON/OFF attribute can be anything true or false, and the values
+# of the others are given as they'd be sent to the fan.
+class BatchAttribute(object):
+    def __init__(self, command, coalesceKey = None, typeId = None, field = None, values = None):
+        self.command = command
+        self.coalesceKey = coalesceKey
+        self.typeId = typeId
+        self.field = field
+        self.values = values
+
+ON_OFF = ( 'ON', 'OFF' )
+
+# Returns ON or OFF for a bool, 1 or 0, or on/off or true/false in any case,
+# and None for anything else
+def onOffValue(value):
+    if isinstance(value, bool) or value in ( 0, 1 ):
+        return 'ON' if value else 'OFF'
+    if isinstance(value, basestring):
+        value = value.strip().lower()
+        if value in ( 'on', 'true', '1' ):
+            return 'ON'
+        if value in ( 'off', 'false', '0' ):
+            return 'OFF'
+    return None
+
+BATCH_ATTRIBUTES = {
+    'fan':          BatchAttribute("FAN;PWR;%s", values = ON_OFF),
+    'speed':        BatchAttribute("FAN;SPD;SET;%s", "FAN;SPD", 'fanSpeed', 'speed'),
+    'light':        BatchAttribute("LIGHT;PWR;%s", values = ON_OFF),
+    'brightness':   BatchAttribute("LIGHT;LEVEL;SET;%s", "LIGHT;LEVEL", 'fanLightBrightness', 'lightLevel'),
+    'fan_motion':   BatchAttribute("FAN;AUTO;%s", values = ON_OFF),
+    'light_motion': BatchAttribute("LIGHT;AUTO;%s", values = ON_OFF),
+    'whoosh':       BatchAttribute("FAN;WHOOSH;%s", values = ON_OFF),
+    'indicators':   BatchAttribute("DEVICE;INDICATORS;%s", values = ON_OFF),
+    'beep':         BatchAttribute("DEVICE;BEEPER;%s", values = ON_OFF),
+    'sleepMode':    BatchAttribute("SLEEP;STATE;%s", values = ON_OFF),
+    'smartmode':    BatchAttribute("SMARTMODE;STATE;SET;%s", values = ( 'HEATING', 'COOLING', 'OFF' )),
+    'direction':    BatchAttribute("FAN;DIR;SET;%s", values = ( 'FWD', 'REV' )),
+    'minSpeed':     BatchAttribute("LEARN;MINSPEED;SET;%s", "LEARN;MINSPEED", 'fanLearnMinSpeed', 'speed'),
+    'maxSpeed':     BatchAttribute("LEARN;MAXSPEED;SET;%s", "LEARN;MAXSPEED", 'fanLearnMaxSpeed', 'speed'),
+}
 
 ################################################################################
 class Plugin(indigo.PluginBase):
@@ -135,8 +1892,26 @@ class Plugin(indigo.PluginBase):
     def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
         indigo.PluginBase.__init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
         self.debug = True
+        self.debugLevel = DEBUG_OFF
 
         self.allfans = {}
+        self.allgroups = {}
+        # Recent debug messages that aren't about any one fan
+        self.history = collections.deque(maxlen = DEBUG_HISTORY_SIZE)
+
+        self.metrics = PluginMetrics()
+        self.metricsPublishAt = 0
+        self.metricsPublishInterval = self.getMetricsPublishInterval(pluginPrefs)
+
+        self.engine = FanEngine(fan_queue, pluginPrefs.get('ioBackend', 'auto'))
+        self.engine.daemon = True
+        self.engine.coalesceWindow = self.getCoalesceWindow(pluginPrefs)
+        self.setHeartbeat(pluginPrefs)
+        self.setDebugLevel(pluginPrefs)
+        self.setCapture(pluginPrefs)
+
+        self.inventory = FanInventory(os.path.join(indigo.server.getInstallFolderPath(), 'Preferences', 'Plugins', pluginId + '.inventory.json'))
+        self.inventory.load()
 
         self.updater = indigoPluginUpdateChecker.updateChecker(self, 'http://bruce.pennypacker.org/files/PluginVersions/SenseME.html', 7)
 
@@ -145,383 +1920,662 @@ class Plugin(indigo.PluginBase):
         indigo.PluginBase.__del__(self)
 
     ########################################
-    def DebugMsg(self, msg):
-        if 'debug' in self.pluginPrefs and self.pluginPrefs['debug'] == True:
+    # Any arguments are only formatted into msg if it's actually going to be
+    # logged, so callers should pass them rather than formatting msg
+    # themselves
+    def DebugMsg(self, msg, *args):
+        if self.debugLevel == DEBUG_LOG:
+            if args:
+                msg = msg % args
             self.debugLog(msg)
 
     ########################################
-    def startup(self):
-        self.DebugMsg(u'startup called')
+    # Debug messages about a fan are also kept in its history
+    def FanDebugMsg(self, devID, msg, *args):
+        if self.debugLevel != DEBUG_OFF:
+            self.recordDebugMsg(devID, time.time(), msg, args)
 
     ########################################
-    def shutdown(self):
-        self.DebugMsg(u"shutdown called")
+    def recordDebugMsg(self, devID, when, msg, args):
+        fan = self.allfans.get(devID)
+        if fan != None:
+            fan.history.append((when, msg, args))
+        else:
+            self.history.append((when, msg, args))
+
+        if self.debugLevel == DEBUG_LOG:
+            msg = formatDebugMsg(msg, args)
+            if fan != None:
+                msg = u"%s : %s" % ( fan.dev.pluginProps['fanName'], msg )
+            self.debugLog(msg)
 
     ########################################
-    def queryFan(self, fanIP, msg, regexp = '\(.*;([^;]+)\)', receive = True):
-        status = ''
+    def setDebugLevel(self, prefs):
+        if prefs.get('debug', False):
+            self.debugLevel = DEBUG_LOG
+        elif prefs.get('debugHistory', False):
+            self.debugLevel = DEBUG_HISTORY
+        else:
+            self.debugLevel = DEBUG_OFF
+
+        self.engine.debugLevel = self.debugLevel
+
+    ########################################
+    def getCoalesceWindow(self, prefs):
         try:
-            sock = socket.socket()
-            sock.settimeout(5)
-            sock.connect((fanIP, 31415))
+            return max(0, int(prefs.get('coalesceMs', int(COALESCE_WINDOW * 1000)))) / 1000.0
+        except ValueError:
+            self.DebugMsg("invalid value in command coalescing setting: %s", prefs['coalesceMs'])
+            return COALESCE_WINDOW
 
-            sock.send(msg)
+    ########################################
+    # An interval of 0 turns heartbeats off
+    def setHeartbeat(self, prefs):
+        try:
+            self.engine.heartbeatInterval = max(0, int(prefs.get('heartbeatSeconds', 0)))
+        except ValueError:
+            self.DebugMsg("invalid value in heartbeat interval setting: %s", prefs['heartbeatSeconds'])
+            self.engine.heartbeatInterval = 0
 
-            if receive == False:
-                self.DebugMsg("sent %s" % (msg))
-                sock.close()
-                return True
+        try:
+            self.engine.heartbeatMisses = max(1, int(prefs.get('heartbeatMisses', HEARTBEAT_MISSES)))
+        except ValueError:
+            self.DebugMsg("invalid value in heartbeat misses setting: %s", prefs['heartbeatMisses'])
+            self.engine.heartbeatMisses = HEARTBEAT_MISSES
 
-            status = sock.recv(1024)
-            sock.close()
-        except socket.error as e:
-            self.DebugMsg("queryFan %s %s failed. %s" % (fanIP, msg, str(e)))
-            return False
+    ########################################
+    # Capture files go in the plugin's own folder in the Indigo logs folder
+    def setCapture(self, prefs):
+        directory = None
 
-        matchObj = re.match(regexp, status)
-        if matchObj:
-            self.DebugMsg("query %s returned: %s" % ( msg, matchObj.group(1) ))
-            return (matchObj.group(1))
-        else:
-            self.DebugMsg("query %s returned: unknown: %s" % ( msg, status ))
-            return False
+        if prefs.get('captureTraffic', False):
+            directory = os.path.join(indigo.server.getInstallFolderPath(), 'Logs', self.pluginId, 'capture')
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                indigo.server.log("Capturing fan traffic in %s" % ( directory ))
+            except OSError as e:
+                self.errorLog("Unable to create %s, not capturing fan traffic: %s" % ( directory, str(e) ))
+                directory = None
+
+        self.engine.setCapture(directory)
+
+    ########################################
+    # Returns 0 if metrics aren't published to variables
+    def getMetricsPublishInterval(self, prefs):
+        if not prefs.get('metricsVariables', False):
+            return 0
+        try:
+            return max(METRICS_INTERVAL, int(prefs.get('metricsInterval', METRICS_PUBLISH_INTERVAL)))
+        except ValueError:
+            self.DebugMsg("invalid value in metrics interval setting: %s", prefs['metricsInterval'])
+            return METRICS_PUBLISH_INTERVAL
+
+    ########################################
+    def closedPrefsConfigUi(self, valuesDict, userCancelled):
+        if not userCancelled:
+            self.engine.coalesceWindow = self.getCoalesceWindow(valuesDict)
+            self.setHeartbeat(valuesDict)
+            self.setDebugLevel(valuesDict)
+            self.metricsPublishInterval = self.getMetricsPublishInterval(valuesDict)
+            self.metricsPublishAt = 0
+            self.setCapture(valuesDict)
+
+    ########################################
+    def startup(self):
+        self.DebugMsg(u'startup called')
+        self.DebugMsg(u'using %s connection engine', self.engine.poller.name)
+        self.engine.start()
+        self.engine.discover()
+
+    ########################################
+    def shutdown(self):
+        self.DebugMsg(u"shutdown called")
+        self.engine.join()
 
     ########################################
     def updateStatusString(self, fan):
-        if fan['light'] == '' or fan['fan'] == '' or fan['fan_level'] == '' or fan['light_level'] == '' :
+        if fan.light == None or fan.fan == None or fan.fan_level == None or fan.light_level == None:
             return
 
-        dev = fan['dev']
-        if fan['light'] == 'OFF':
-            l = 'off'
-        else:
+        dev = fan.dev
+        if fan.light:
             l = 'on'
-
-        if fan['fan'] == 'OFF':
-            f = 'off'
         else:
+            l = 'off'
+
+        if fan.fan:
             f = 'on'
+        else:
+            f = 'off'
 
         if 'debug' in self.pluginPrefs and self.pluginPrefs['debug']:
-            s = "%s / %s (f:%s, l:%s)" % (f, l, fan['fan_level'], fan['light_level'])
+            s = "%s / %s (f:%d, l:%d)" % (f, l, fan.fan_level, fan.light_level)
         else:
             s = "%s / %s" % (f, l)
 
-        if s != fan['status_string']:
-            fan['status_string'] = s
-            dev.updateStateOnServer('statusString', s)
-
-            if fan['fan_level'] == '0':
-                dev.updateStateImageOnServer(indigo.kStateImageSel.FanOff)
-            elif fan['fan_level'] in [ '1', '2' ]:
-                dev.updateStateImageOnServer(indigo.kStateImageSel.FanLow)
-            elif fan['fan_level'] in [ '3', '4' ]:
-                dev.updateStateImageOnServer(indigo.kStateImageSel.FanMedium)
-            elif fan['fan_level'] in [ '5', '6', '7' ]:
-                dev.updateStateImageOnServer(indigo.kStateImageSel.FanHigh)
-            else:
-                dev.updateStateImageOnServer(indigo.kStateImageSel.Error)
+        if s != fan.statusString:
+            fan.statusString = s
+            self.queueStateUpdate(fan, 'statusString', s)
+
+            image = fanStateImage(fan.fan_level)
+            if image != fan.stateImage:
+                fan.stateImage = image
+                dev.updateStateImageOnServer(image)
+
+    ########################################
+    # State changes are collected per fan while a batch of messages is being
+    # processed and then sent to the server together by flushFanStates.
+    def queueStateUpdate(self, fan, state, value, uiValue = None, trigger = True):
+        pending = fan.pending
+
+        # If a state changes more than once within a batch then send what's
+        # pending first so that every change, and any trigger on it, reaches
+        # the server in order.
+        if state in pending:
+            self.flushFanStates(fan)
+            pending = fan.pending
+
+        update = { 'key' : state, 'value' : value }
+        if uiValue != None:
+            update['uiValue'] = uiValue
+
+        pending[state] = (update, trigger)
+
+    ########################################
+    def flushFanStates(self, fan):
+        self.updateStatusString(fan)
+
+        pending = fan.pending
+        if not pending:
+            return
+
+        fan.pending = {}
+
+        dev = fan.dev
+        silent = [ update for update, trigger in pending.values() if not trigger ]
+        triggered = [ update for update, trigger in pending.values() if trigger ]
+
+        # A fan that isn't confirming commands stays in its error state until
+        # it confirms one again, however many states it reports meanwhile
+        if silent:
+            dev.updateStatesOnServer(silent, triggerEvents = False, clearErrorState = False)
+        if triggered:
+            dev.updateStatesOnServer(triggered, clearErrorState = False)
 
     ########################################
-    def getFanStatus(self, fan):
-        dev = fan['dev']
-        fanName = dev.pluginProps['fanName']
+    # Sends a group's states to the server, only those that have changed
+    def flushGroupStates(self, group):
+        group.dirty = False
+        dev = group.dev
+
+        updates = []
+        for state, value in group.summary():
+            if group.states.get(state) != value:
+                group.states[state] = value
+                updates.append({ 'key' : state, 'value' : value })
+
+        if updates:
+            dev.updateStatesOnServer(updates)
+
+        image = fanStateImage(group.states['speed'] if group.fansOn else 0)
+        if image != group.stateImage:
+            group.stateImage = image
+            dev.updateStateImageOnServer(image)
+
+    ########################################
+    def deviceStartComm(self, dev):
+        dev.stateListOrDisplayStateIdChanged() # in case any states added/removed after plugin upgrade
+
+        if dev.deviceTypeId == 'SenseME_group':
+            self.startGroup(dev)
+            return
+
+        timeout = 0
+
+        try:
+            if 'timeoutValue' in self.pluginPrefs and int(self.pluginPrefs['timeoutValue']) > 0:
+                timeout = int(self.pluginPrefs['timeoutValue'])
+        except:
+            self.DebugMsg("invalid value in timeout setting: %s", self.pluginPrefs['timeoutValue'])
+
+        self.DebugMsg("Starting device '%s'", dev.name)
+
+        if dev.id in self.allfans:
+            self.DebugMsg("Found device %d already running. Ignoring...", dev.id)
+            return
+
         fanIP = dev.pluginProps['fanIP']
 
-        msg = "<%s;DEVICE;ID;GET>" % ( fanName )
-        res = self.queryFan(fanIP, msg, regexp = '\(.*;([^;]+);[^;]+\)')
-        if res:
-            fan['MAC'] = res
-            fanName = res
-            props = dev.pluginProps
-            props["fanMAC"] = res
-            dev.replacePluginPropsOnServer(props)
+        fan = FanState(dev)
+        fan.groups = [ group for group in self.allgroups.values() if dev.id in group.members ]
+
+        self.allfans[dev.id] = fan
+
+        # The engine connects and, unless the MAC address is already cached,
+        # learns it in the background, so starting a device never waits on
+        # the fan
+        self.engine.addFan(dev.id, fanIP, timeout, dev.pluginProps['fanName'], fan.MAC)
+
+    ########################################
+    def debugState(self, action):
+        dev = indigo.devices[action.deviceId]
+        fan = self.allfans[dev.id]
+        self.DebugMsg("dumping fan state:")
+        self.DebugMsg("Fan name    : %s", fan.dev.name)
+        self.DebugMsg("MAC         : %s", fan.MAC)
+        for field, label in FAN_STATE_SCHEMA:
+            self.DebugMsg("%-12s: %s", label, getattr(fan, field))
+        self.DebugMsg("status      : %s", fan.statusString)
+        conn = self.engine.fans.get(dev.id)
+        if conn != None:
+            self.DebugMsg("superseded  : %d", conn.superseded)
+        self.DebugMsg("dump complete")
+
+
+    ########################################
+    # Members may be started before or after their groups
+    def startGroup(self, dev):
+        self.DebugMsg("Starting group '%s'", dev.name)
+
+        if dev.id in self.allgroups:
+            self.DebugMsg("Found group %d already running. Ignoring...", dev.id)
+            return
+
+        group = FanGroup(dev, groupMembers(dev.pluginProps))
+        self.allgroups[dev.id] = group
+
+        for devID in group.members:
+            fan = self.allfans.get(devID)
+            if fan != None:
+                fan.groups.append(group)
+                group.add(fan)
+
+        self.flushGroupStates(group)
+
+    ########################################
+    def deviceStopComm(self, dev):
+        self.DebugMsg("Stopping device %s.", dev.name)
+
+        if dev.deviceTypeId == 'SenseME_group':
+            group = self.allgroups.pop(dev.id, None)
+            if group:
+                for devID in group.members:
+                    fan = self.allfans.get(devID)
+                    if fan != None and group in fan.groups:
+                        fan.groups.remove(group)
+            return
+
+        fan = self.allfans[dev.id]
+
+        if fan:
+            self.engine.removeFan(dev.id)
+            self.metrics.forget(dev.id)
+            del self.allfans[dev.id]
+
+            # The fan's last known state no longer counts towards its groups
+            for group in fan.groups:
+                group.remove(fan)
+                self.flushGroupStates(group)
+
+    ########################################
+    def processFanMessage(self, fan, data):
+
+        self.FanDebugMsg(fan.dev.id, 'processing message %s', data)
+
+        if len(data) < 2 or data[0] != '(' or data[-1] != ')':
+            self.metrics.parseFailures[fan.dev.id] += 1
+            return
+
+        params = data[1:-1].split(';')
+
+        msg = findFanMessage(params)
+        if msg == None:
+            return
+        if len(params) <= msg.index:
+            self.metrics.parseFailures[fan.dev.id] += 1
+            return
+
+        raw = params[msg.index]
+
+        if msg.handler != None:
+            getattr(self, msg.handler)(fan, raw)
+            return
+
+        try:
+            value = msg.parse(raw)
+        except ValueError:
+            self.FanDebugMsg(fan.dev.id, 'invalid %s in message %s', msg.label, data)
+            self.metrics.parseFailures[fan.dev.id] += 1
+            return
+
+        old = getattr(fan, msg.field)
+        if old != value:
+            dev = fan.dev
+
+            if msg.trigger == TRIGGER_ALWAYS:
+                trigger = True
+            else:
+                trigger = ( old != None )
+
+            stateValue, uiValue = msg.convert(dev, value)
+
+            if uiValue == None:
+                self.FanDebugMsg(dev.id, 'Changing %s to %s (trigger: %s)', msg.label, raw, trigger)
+            else:
+                self.FanDebugMsg(dev.id, 'Changing %s to %s (trigger: %s)', msg.label, uiValue, trigger)
+
+            self.queueStateUpdate(fan, msg.state, stateValue, uiValue, trigger)
+            setattr(fan, msg.field, value)
+
+            for group in fan.groups:
+                group.update(msg.field, old, value)
+
+    ########################################
+    def updateFanID(self, fan, mac):
+        if fan.MAC != mac:
+            dev = fan.dev
+            self.FanDebugMsg(dev.id, "Setting MAC to '%s'", mac)
+            fan.MAC = mac
+            self.engine.setFanID(dev.id, mac)
+
+            # Only write the props when the cached address actually changes
+            props = dev.pluginProps
+            if props.get("fanMAC", '') != mac:
+                props["address"] = props['fanIP']
+                props["fanMAC"] = fan.MAC
+                dev.replacePluginPropsOnServer(props)
+
+    ########################################
+    def runConcurrentThread(self):
+        global fan_queue
+
+        self.DebugMsg(u"starting runConcurrentThread()")
+
+        # Block until something arrives rather than polling so that state
+        # changes reach Indigo as soon as the engine queues them. Whatever
+        # else is already waiting is drained in the same pass.
+        try:
+            while not self.stopThread:
+                batch = fan_queue.getBatch(DISPATCH_BATCH)
+                self.metrics.queueDepth.add(len(batch) + fan_queue.depth())
+
+                self.dispatchMessages(batch)
+
+                debugDropped, eventsDropped = fan_queue.takeDropped()
+                if debugDropped:
+                    self.metrics.debugDropped += debugDropped
+                    self.DebugMsg("dispatcher behind, dropped %d debug messages", debugDropped)
+                if eventsDropped:
+                    self.metrics.eventsDropped += eventsDropped
+                    self.DebugMsg("dispatcher behind, dropped %d fan messages", eventsDropped)
+
+        except self.StopThread:
+            pass
+
+        self.DebugMsg(u"exiting runConcurrentThread()")
 
     ########################################
-    def deviceStartComm(self, dev):
+    def stopConcurrentThread(self):
         global fan_queue
 
-        dev.stateListOrDisplayStateIdChanged() # in case any states added/removed after plugin upgrade
-
-        timeout = 0
+        indigo.PluginBase.stopConcurrentThread(self)
 
-        try:
-            if 'timeoutValue' in self.pluginPrefs and int(self.pluginPrefs['timeoutValue']) > 0:
-                timeout = int(self.pluginPrefs['timeoutValue'])
-        except:
-            self.DebugMsg("invalid value in timeout setting: %s" % ( self.pluginPrefs['timeoutValue'] ))
+        # Wake the dispatcher if it's waiting on an empty queue
+        fan_queue.put((MSG_WAKE, None, ""))
 
-        self.DebugMsg("Starting device '%s'" % dev.name)
+    ########################################
+    def dispatchMessages(self, batch):
+        updated = {}
+        received = []
 
-        if dev.id in self.allfans:
-            self.DebugMsg("Found device %d already running. Ignoring..." % ( dev.id ))
-            return
+        for msgtype, devID, data in batch:
+            if msgtype == MSG_DISCOVERED:
+                self.fanDiscovered(*data)
+                continue
 
-        fanIP = dev.pluginProps['fanIP']
+            if msgtype == MSG_METRICS:
+                self.sampleMetrics(data)
+                continue
 
-        fan = {
-                'MAC'             : '',
-                'light'           : '',
-                'fan'             : '',
-                'light_level'     : '',
-                'fan_level'       : '',
-                'light_auto'      : '',
-                'fan_auto'        : '',
-                'smartmode'       : '',
-                'motion'          : '',
-                'whoosh'          : '',
-                'beep'            : '',
-                'indicators'      : '',
-                'direction'       : '',
-                'coolingIdealTemp': '',
-                'sleepIdealTemp'  : '',
-                'status_string'   : '',
-                'sleepMode'       : '',
-                'dev'             : dev
-              }
+            if msgtype == MSG_DEBUG:
+                self.recordDebugMsg(devID, *data)
+                continue
 
-        self.allfans[dev.id] = fan
+            if devID in self.allfans:
+                fan = self.allfans[devID]
+            else:
+                continue
 
-        self.getFanStatus(fan)
+            if msgtype == MSG_REINIT:
+                # Keep what's known about the fan. Its replies to the GETALL
+                # sent on reconnecting are compared with it like any other
+                # message, so only the states that changed while it was
+                # disconnected are written to the server.
+                fan.resync = fan.snapshot()
+
+            elif msgtype == MSG_FAN:
+                frame, when = data
+                self.processFanMessage(fan, frame)
+                updated[devID] = fan
+                received.append(when)
+
+                # The motion sensor status is asked for after the GETALL, so
+                # its reply is the last one
+                if fan.resync != None and ';SNSROCC;STATUS;' in frame:
+                    self.FanDebugMsg(devID, "Resynced after reconnecting, changed: %s", ', '.join(fan.diff(fan.resync)) or 'nothing')
+                    fan.resync = None
+
+            elif msgtype == MSG_IDENTITY:
+                # The fan didn't answer to its cached MAC address. Address it
+                # by name until it reports its identity again.
+                fan.MAC = ''
+
+            elif msgtype == MSG_COMMAND_FAILED:
+                self.errorLog("%s didn't respond to %s" % ( fan.dev.name, data ))
+                fan.dev.setErrorStateOnServer("no response")
+
+            elif msgtype == MSG_COMMAND_OK:
+                indigo.server.log("%s is responding again" % ( fan.dev.name ))
+                fan.dev.setErrorStateOnServer(None)
+
+        # Send each fan's state changes from the whole batch to the server at
+        # once, and then those of the groups it's in
+        for fan in updated.values():
+            self.flushFanStates(fan)
+            for group in fan.groups:
+                if group.dirty:
+                    self.flushGroupStates(group)
+
+        if received:
+            now = time.time()
+            latency = self.metrics.latency
+            for when in received:
+                latency.add((now - when) * 1000)
 
-        f = fan['MAC']
-        if f == '':
-            f = dev.name
+    ########################################
+    # Called every METRICS_INTERVAL by way of the engine
+    def sampleMetrics(self, now):
+        self.metrics.sample(now, self.engine.fans.values())
 
-        thread = FanListener(fan_queue, dev.id, fanIP, timeout, f)
-        fan['thread'] = thread
-        thread.daemon = True
-        thread.start()
+        if self.metricsPublishInterval and now >= self.metricsPublishAt:
+            self.metricsPublishAt = now + self.metricsPublishInterval
+            self.publishMetrics()
 
     ########################################
-    def debugState(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-        self.DebugMsg("dumping fan dict:")
-        self.DebugMsg("Fan name    : %s" % ( fan['dev'].name ))
-        self.DebugMsg("MAC         : %s" % ( fan['MAC'] ))
-        self.DebugMsg("light       : %s" % ( fan['light'] ))
-        self.DebugMsg("fan         : %s" % ( fan['fan'] ))
-        self.DebugMsg("light level : %s" % ( fan['light_level'] ))
-        self.DebugMsg("fan level   : %s" % ( fan['fan_level'] ))
-        self.DebugMsg("light auto  : %s" % ( fan['light_auto'] ))
-        self.DebugMsg("fan auto    : %s" % ( fan['fan_auto'] ))
-        self.DebugMsg("smart mode  : %s" % ( fan['smartmode'] ))
-        self.DebugMsg("motion      : %s" % ( fan['motion'] ))
-        self.DebugMsg("whoosh      : %s" % ( fan['whoosh'] ))
-        self.DebugMsg("beep        : %s" % ( fan['beep'] ))
-        self.DebugMsg("indicators  : %s" % ( fan['indicators'] ))
-        self.DebugMsg("direction   : %s" % ( fan['direction'] ))
-        self.DebugMsg("cooling temp: %s" % ( fan['coolingIdealTemp'] ))
-        self.DebugMsg("sleep temp  : %s" % ( fan['sleepIdealTemp'] ))
-        self.DebugMsg("status      : %s" % ( fan['status_string'] ))
-        self.DebugMsg("sleep mode  : %s" % ( fan['sleepMode'] ))
-        self.DebugMsg("dump complete")
+    # Totals across all the fans, as ( name, value ) pairs
+    def metricsSummary(self):
+        conns = self.engine.fans.values()
+        metrics = self.metrics
+        return [
+            ( 'messagesPerSecond', "%.2f" % ( sum(metrics.rates.values()) ) ),
+            ( 'messagesReceived',  sum(conn.received for conn in conns) ),
+            ( 'queueDepth',        fan_queue.depth() ),
+            ( 'latencyMs95',       "%.1f" % ( metrics.latency.percentile(95) ) ),
+            ( 'commandsRequested', sum(metrics.commands.values()) ),
+            ( 'commandsSent',      sum(conn.sent for conn in conns) + self.engine.datagrams ),
+            ( 'commandRttMs95',    "%.1f" % ( self.engine.commandRtt.percentile(95) ) ),
+            ( 'commandRetries',    sum(conn.retries for conn in conns) ),
+            ( 'commandFailures',   sum(conn.commandFailures for conn in conns) ),
+            ( 'heartbeatRttMs95',  "%.1f" % ( self.engine.heartbeatRtt.percentile(95) ) ),
+            ( 'heartbeatFailures', sum(conn.heartbeatFailures for conn in conns) ),
+            ( 'reconnects',        sum(conn.reconnects for conn in conns) ),
+            ( 'parseFailures',     sum(metrics.parseFailures.values()) ),
+            ( 'debugDropped',      metrics.debugDropped ),
+            ( 'eventsDropped',     metrics.eventsDropped ),
+        ]
 
+    ########################################
+    # Writes the metrics to variables in a SenseME folder, creating them
+    # as needed
+    def publishMetrics(self):
+        try:
+            if METRICS_FOLDER not in indigo.variables.folders:
+                indigo.variables.folder.create(METRICS_FOLDER)
+            folder = indigo.variables.folders[METRICS_FOLDER].id
+
+            for name, value in self.metricsSummary():
+                name = METRICS_VARIABLE_PREFIX + name
+                if name in indigo.variables:
+                    indigo.variable.updateValue(name, str(value))
+                else:
+                    indigo.variable.create(name, str(value), folder = folder)
+        except Exception as e:
+            self.errorLog("Unable to publish metrics: %s" % ( str(e) ))
+            self.metricsPublishInterval = 0
 
     ########################################
-    def deviceStopComm(self, dev):
-        self.DebugMsg("Stopping device %s." % dev.name)
+    def logMetrics(self):
+        metrics = self.metrics
+
+        indigo.server.log("SenseME metrics, %d seconds since startup:" % ( time.time() - metrics.started ))
+        lines = self.metricsSummary() + [
+            ( 'latency (ms)',         metrics.latency.summary() ),
+            ( 'command rtt (ms)',     self.engine.commandRtt.summary() ),
+            ( 'heartbeat rtt (ms)',   self.engine.heartbeatRtt.summary() ),
+            ( 'queue depth',          metrics.queueDepth.summary() ),
+            ( 'fan messages/s',       metrics.fanRate.summary() ),
+            ( 'commands superseded',  self.engine.superseded ),
+            ( 'messages superseded',  fan_queue.superseded ),
+        ]
+        for name, value in lines:
+            indigo.server.log("  %-20s: %s" % ( name, value ))
+
+        for fan in sorted(self.allfans.values(), key = lambda fan: fan.dev.name):
+            devID = fan.dev.id
+            conn = self.engine.fans.get(devID)
+            if conn == None:
+                continue
+            indigo.server.log("  %s: %.2f msg/s, %d received, %d commands, %d sent, %d retries, %d failed, rtt p50 %.1f p95 %.1f ms, heartbeat rtt p50 %.1f p95 %.1f ms, %d heartbeat failures, %d reconnects, %d parse failures, %d bytes discarded" %
+                ( fan.dev.name, metrics.rates.get(devID, 0), conn.received, metrics.commands[devID], conn.sent,
+                  conn.retries, conn.commandFailures, conn.rtt.percentile(50), conn.rtt.percentile(95),
+                  conn.heartbeatRtt.percentile(50), conn.heartbeatRtt.percentile(95), conn.heartbeatFailures,
+                  conn.reconnects, metrics.parseFailures[devID], conn.discarded ))
 
-        fan = self.allfans[dev.id]
+    ########################################
+    def fanDiscovered(self, name, mac, ip):
+        self.DebugMsg("discovered fan '%s' (%s) at %s", name, mac, ip)
 
-        if fan:
-            fan['thread'].join()
-            del self.allfans[dev.id]
+        if self.inventory.update(name, mac, ip):
+            try:
+                self.inventory.save()
+            except (IOError, OSError) as e:
+                self.errorLog("unable to save fan inventory: %s" % ( str(e) ))
+
+        # Follow fans whose address has changed, for instance after a DHCP
+        # lease expired. Changing fanIP restarts the device on the new address.
+        for fan in self.allfans.values():
+            dev = fan.dev
+            props = dev.pluginProps
+            if fan.MAC == mac or (fan.MAC == '' and props['fanName'] == name):
+                if props['fanIP'] != ip:
+                    indigo.server.log("%s has moved from %s to %s" % (dev.name, props['fanIP'], ip))
+                    props['fanIP'] = ip
+                    props['address'] = ip
+                    dev.replacePluginPropsOnServer(props)
 
     ########################################
-    def processFanMessage(self, fan, data):
+    def discoverFans(self):
+        self.engine.discover()
 
-        self.DebugMsg('processing message %s' % (data))
-
-        matchObj = re.match('\((.*)\)', data)
-        if matchObj:
-            cmdStr = matchObj.group(1)
-            params = cmdStr.split(';')
-            fanName = params[0]
-
-            dev = fan['dev']
-
-            if ';LIGHT;LEVEL;ACTUAL;' in cmdStr:
-                if fan['light_level'] != params[4]:
-                    trigger = ( fan['light_level'] != '' )
-                    self.DebugMsg('Changing light level to %s (trigger:%s)' % (params[4], trigger))
-                    dev.updateStateOnServer('brightness', int(params[4]), triggerEvents = trigger)
-                    fan['light_level'] = params[4]
-            elif ';FAN;SPD;ACTUAL;' in cmdStr:
-                if fan['fan_level'] != params[4]:
-                    trigger = ( fan['fan_level'] != '' )
-                    self.DebugMsg('Changing fan speed to %s (trigger: %s)' % (params[4], trigger))
-                    dev.updateStateOnServer('speed', int(params[4]), triggerEvents = trigger)
-                    fan['fan_level'] = params[4]
-            elif ';FAN;AUTO;' in cmdStr:
-                if fan['fan_auto'] != params[3]:
-                    trigger = ( fan['fan_auto'] != '' )
-                    self.DebugMsg('Changing fan motion to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('fan_motion', params[3], triggerEvents = trigger)
-                    fan['fan_auto'] = params[3]
-            elif ';LIGHT;AUTO;' in cmdStr:
-                if fan['light_auto'] != params[3]:
-                    trigger = ( fan['light_auto'] != '' )
-                    self.DebugMsg('Changing light motion to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('light_motion', params[3], triggerEvents = trigger)
-                    fan['light_auto'] = params[3]
-            elif ';LIGHT;PWR;' in cmdStr:
-                if fan['light'] != params[3]:
-                    trigger = ( fan['light'] != '' )
-                    self.DebugMsg('Changing light to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('light', (params[3] == 'ON'))
-                    fan['light'] = params[3]
-            elif ';FAN;PWR;' in cmdStr:
-                if fan['fan'] != params[3]:
-                    trigger = ( fan['fan'] != '' )
-                    self.DebugMsg('Changing fan to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('fan', (params[3] == 'ON'), triggerEvents = trigger)
-                    fan['fan'] = params[3]
-            elif ';DEVICE;ID;' in cmdStr:
-                if fan['MAC'] != params[3]:
-                    props = dev.pluginProps
-                    props["address"] = addr[0]
-                    self.DebugMsg("Setting MAC to '%s'" % ( params[3] ))
-                    fan['MAC'] = params[3] # MAC address
-                    props["fanMAC"] = fan['MAC']
-                    dev.replacePluginPropsOnServer(props)
-            elif ';SMARTMODE;ACTUAL' in cmdStr:
-                if fan['smartmode'] != params[3]:
-                    trigger = ( fan['smartmode'] != '' )
-                    self.DebugMsg('Changing smartmode to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('smartmode', params[3], triggerEvents = trigger)
-                    fan['smartmode'] = params[3]
-            elif ';SNSROCC;STATUS;' in cmdStr:
-                if fan['motion'] != params[3]:
-                    trigger = ( fan['motion'] != '' )
-                    self.DebugMsg('Changing motion to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('motion', (params[3] == 'OCCUPIED'))
-                    fan['motion'] = params[3]
-            elif ';FAN;WHOOSH;STATUS;' in cmdStr:
-                if fan['whoosh'] != params[4]:
-                    trigger = ( fan['whoosh'] != '' )
-                    self.DebugMsg('Changing whoosh to %s (trigger: %s)' % (params[4], trigger))
-                    dev.updateStateOnServer('whoosh', params[4], triggerEvents = trigger)
-                    fan['whoosh'] = params[4]
-            elif ';DEVICE;BEEPER;' in cmdStr:
-                if fan['beep'] != params[3]:
-                    trigger = ( fan['beep'] != '' )
-                    self.DebugMsg('Changing beep to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('beep', params[3], triggerEvents = trigger)
-                    fan['beep'] = params[3]
-            elif ';DEVICE;INDICATORS;' in cmdStr:
-                if fan['indicators'] != params[3]:
-                    trigger = ( fan['indicators'] != '' )
-                    self.DebugMsg('Changing indicators to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('indicators', params[3], triggerEvents = trigger)
-                    fan['indicators'] = params[3]
-            elif ';FAN;DIR;' in cmdStr: # FWD or REV
-                if params[3] == 'FWD':
-                    direction = "forward"
-                elif params[3] == 'REV':
-                    direction = "reverse"
-                else:
-                    direction = "unknown"
-                if fan['direction'] != direction:
-                    trigger = ( fan['direction'] != '' )
-                    self.DebugMsg('Changing direction to %s (trigger: %s)' % (direction, trigger))
-                    dev.updateStateOnServer('direction', direction, triggerEvents = trigger)
-                    fan['direction'] = direction
-            elif ';LEARN;ZEROTEMP;' in cmdStr:
-                if fan['coolingIdealTemp'] != params[3]:
-                    trigger = ( fan['coolingIdealTemp'] != '' )
-                    tempUnits = dev.pluginProps['fanTempUnits']
-                    if tempUnits == 'C':
-                        temp = str(int(params[3]) / 100)
-                    else:
-                        # Divide by 100, then F = C * 9/5 + 32
-                        temp = str(float((int(params[3]) / 100) * 9 ) / 5 + 32)
-
-                    uiTemp = "%s %s" % ( temp, tempUnits )
-
-                    self.DebugMsg('Changing cooling ideal temperature %s %s (trigger: %s)' % (temp, tempUnits, trigger))
-                    dev.updateStateOnServer('coolingIdealTemp', temp, triggerEvents = trigger, uiValue = uiTemp)
-                    fan['coolingIdealTemp'] = params[3]
-            elif ';SMARTSLEEP;IDEALTEMP;' in cmdStr:
-                if fan['sleepIdealTemp'] != params[3]:
-                    trigger = ( fan['sleepIdealTemp'] != '' )
-                    tempUnits = dev.pluginProps['fanTempUnits']
-                    if tempUnits == 'C':
-                        temp = str(int(params[3]) / 100)
-                    else:
-                        # Divide by 100, then F = C * 9/5 + 32
-                        temp = str(float((int(params[3]) / 100) * 9 ) / 5 + 32)
+        # Replies arrive on the engine thread and are added to the inventory
+        # by the dispatcher, so just give them time to come in
+        time.sleep(DISCOVERY_WINDOW)
+
+        return self.inventory.all()
 
-                    uiTemp = "%s %s" % ( temp, tempUnits )
+    ########################################
+    def discoverFansMenu(self):
+        fans = self.discoverFans()
 
-                    self.DebugMsg('Changing sleep ideal temperature %s %s (trigger: %s)' % (temp, tempUnits, trigger))
-                    dev.updateStateOnServer('sleepIdealTemp', temp, triggerEvents = trigger, uiValue = uiTemp)
-                    fan['sleepIdealTemp'] = params[3]
-            elif ';SLEEP;STATE;' in cmdStr:
-                if fan['sleepMode'] != params[3]:
-                    trigger = ( fan['sleepMode'] != '' )
-                    self.DebugMsg('Changing sleep mode to %s (trigger: %s)' % (params[3], trigger))
-                    dev.updateStateOnServer('sleepMode', params[3], triggerEvents = trigger)
-                    fan['sleepMode'] = params[3]
+        if not fans:
+            indigo.server.log("No SenseME fans found")
 
-            self.updateStatusString(fan)
+        for fan in fans:
+            indigo.server.log("Found fan '%s' (%s) at %s" % (fan['name'], fan['mac'], fan['ip']))
 
     ########################################
-    def runConcurrentThread(self):
-        global fan_queue
+    # Writes the recent debug messages kept for each fan to the log
+    def dumpDebugHistory(self):
+        if self.debugLevel == DEBUG_OFF:
+            indigo.server.log("Debug history is only kept while debugging or debug history is enabled in the plugin settings")
+            return
 
-        self.DebugMsg(u"starting runConcurrentThread()")
+        self.logDebugHistory("plugin", self.history)
+        for fan in sorted(self.allfans.values(), key = lambda fan: fan.dev.name):
+            self.logDebugHistory(fan.dev.name, fan.history)
 
-        while True:
-            try:
-                msg = fan_queue.get(block=False)
+    ########################################
+    def logDebugHistory(self, name, history):
+        indigo.server.log("Debug history for %s (%d messages):" % ( name, len(history) ))
+        for when, msg, args in list(history):
+            msg = formatDebugMsg(msg, args)
+            stamp = time.strftime("%H:%M:%S", time.localtime(when))
+            indigo.server.log("  %s.%03d %s" % ( stamp, int(when * 1000) % 1000, msg ))
 
-                msgtype = msg[0]
-                devID = msg[1]
-                data = msg[2]
-                fan = None
+    ########################################
+    def discoverFansButton(self, valuesDict, typeId, devId):
+        self.discoverFans()
+        return valuesDict
 
-                if devID in self.allfans:
-                    fan = self.allfans[devID]
-                else:
-                    continue
+    ########################################
+    def discoveredFanList(self, filter = "", valuesDict = None, typeId = "", targetId = 0):
+        return [ (fan['mac'], "%s (%s)" % (fan['name'], fan['ip'])) for fan in self.inventory.all() ]
 
-                name = fan['dev'].pluginProps['fanName']
-
-                if msgtype == MSG_DEBUG:
-                    self.DebugMsg('%s : %s' % (name, data))
-
-                elif msgtype == MSG_REINIT:
-                    fan['light'] = ''
-                    fan['fan'] = ''
-                    fan['light_level'] = ''
-                    fan['fan_level'] = ''
-                    fan['light_auto'] = ''
-                    fan['fan_auto'] = ''
-                    fan['smartmode'] = ''
-                    fan['motion'] = ''
-                    fan['whoosh'] = ''
-                    fan['beep'] = ''
-                    fan['indicators'] = ''
-                    fan['direction'] = ''
-                    fan['coolingIdealTemp'] = ''
-                    fan['sleepIdealTemp'] = ''
-                    fan['status_string'] = ''
-                    fan['sleepMode'] = ''
-                    self.getFanStatus(fan)
-
-                elif msgtype == MSG_FAN:
-                    self.processFanMessage(fan, data)
-
-                fan_queue.task_done()
-
-            except Queue.Empty as e:
-                self.sleep(1)
-                continue
+    ########################################
+    def discoveredFanSelected(self, valuesDict, typeId, devId):
+        fan = self.inventory.byMAC(valuesDict.get('discoveredFan', ''))
+        if fan != None:
+            valuesDict['fanName'] = fan['name']
+            valuesDict['fanIP'] = fan['ip']
+            valuesDict['fanMAC'] = fan['mac']
+        return valuesDict
+
+    ########################################
+    # Only the fan's name and address require reconnecting. Other prop changes,
+    # such as learning the MAC address, don't.
+    def didDeviceCommPropertyChange(self, origDev, newDev):
+        for prop in [ 'fanIP', 'fanName', 'members' ]:
+            if origDev.pluginProps.get(prop) != newDev.pluginProps.get(prop):
+                return True
+        return False
 
     ########################################
     def validateDeviceConfigUi(self, valuesDict, typeId, devId):
+        if typeId == 'SenseME_group':
+            if not groupMembers(valuesDict):
+                errorsDict = indigo.Dict()
+                errorsDict['members'] = "Choose at least one fan"
+                return (False, valuesDict, errorsDict)
+            return (True, valuesDict)
+
+        # Fill in the address of a fan that's been discovered if it was left out
+        if not valuesDict['fanIP']:
+            fan = self.inventory.byName(valuesDict['fanName'])
+            if fan != None:
+                valuesDict['fanIP'] = fan['ip']
+                valuesDict['fanMAC'] = fan['mac']
+
         fanIP = valuesDict['fanIP']
         fanName = valuesDict['fanName']
         tempUnits = valuesDict['fanTempUnits']
@@ -541,48 +2595,156 @@ class Plugin(indigo.PluginBase):
             return (False, valuesDict, errorsDict)
 
         dev = indigo.devices[devId]
-        fan = self.allfans[dev.id]
+        fan = self.allfans.get(dev.id)
 
-        if tempUnits == 'C':
-            temp = int(float(fan['coolingIdealTemp']) / 100.0)
-            dev.updateStateOnServer('coolingIdealTemp', temp)
+        # Redisplay the temperatures in the (possibly changed) units
+        if fan != None and fan.coolingIdealTemp != None and fan.sleepIdealTemp != None:
+            if tempUnits == 'C':
+                temp = int(fan.coolingIdealTemp / 100.0)
+                dev.updateStateOnServer('coolingIdealTemp', temp)
 
-            temp = int(float(fan['sleepIdealTemp']) / 100.0)
-            dev.updateStateOnServer('sleepIdealTemp', temp)
-        else:
-            temp = int((int(fan['coolingIdealTemp']) / 100.0) * 9 / 5) + 32
-            dev.updateStateOnServer('coolingIdealTemp', temp)
+                temp = int(fan.sleepIdealTemp / 100.0)
+                dev.updateStateOnServer('sleepIdealTemp', temp)
+            else:
+                temp = int((fan.coolingIdealTemp / 100.0) * 9 / 5) + 32
+                dev.updateStateOnServer('coolingIdealTemp', temp)
 
-            temp = int((int(fan['sleepIdealTemp']) / 100.0) * 9 / 5) + 32
-            dev.updateStateOnServer('sleepIdealTemp', temp)
+                temp = int((fan.sleepIdealTemp / 100.0) * 9 / 5) + 32
+                dev.updateStateOnServer('sleepIdealTemp', temp)
 
         msg = "<%s;DEVICE;ID;GET>" % ( fanName )
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.engine.sendCommand(devId, fanIP, encodeMessage(msg))
 
         return (True, valuesDict)
 
     ########################################
-    def setFanLightOn(self, action):
-        dev = indigo.devices[action.deviceId]
+    # The fan is addressed by its MAC address once that's known and by its
+    # name until then.
+    def fanAddress(self, dev):
+        fan = self.allfans.get(dev.id)
+        if fan and fan.MAC != '':
+            return fan.MAC
+        return dev.pluginProps['fanName']
 
-        fanName = dev.pluginProps['fanName']
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;LIGHT;PWR;ON>" % ( fanName )
+    ########################################
+    # Commands for a group are sent to each of its members
+    def sendFanCommand(self, dev, cmd, coalesceKey = None):
+        if dev.deviceTypeId == 'SenseME_group':
+            self.engine.sendCommands([ self.fanCommand(fan.dev, cmd, coalesceKey) for fan in self.groupFans(dev) ])
+        else:
+            self.engine.sendCommand(*self.fanCommand(dev, cmd, coalesceKey))
+
+    ########################################
+    # Returns the engine's ( devID, fanIP, msg, coalesceKey ) for a command
+    def fanCommand(self, dev, cmd, coalesceKey = None):
+        msg = "<%s;%s>" % ( self.fanAddress(dev), cmd )
+
+        self.FanDebugMsg(dev.id, "Sending %s", msg)
+        self.metrics.commands[dev.id] += 1
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        return ( dev.id, dev.pluginProps['fanIP'], encodeMessage(msg), coalesceKey )
 
     ########################################
-    def setFanLightOff(self, action):
-        dev = indigo.devices[action.deviceId]
+    # The members of a group that have been started
+    def groupFans(self, dev):
+        group = self.allgroups.get(dev.id)
+        if group == None:
+            return []
+        return [ self.allfans[devID] for devID in group.members if devID in self.allfans ]
 
-        fanName = dev.pluginProps['fanName']
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;LIGHT;PWR;OFF>" % ( fanName )
+    ########################################
+    # Sets many attributes of many fans, or groups, in one call, for scripts.
+    # action.props['operations'] is a list of ( device, attribute, value ),
+    # or a JSON string of one, where device is a device ID or name and the
+    # attributes are those in BATCH_ATTRIBUTES. Every operation is checked
+    # before anything is sent, and then those that passed are all sent in one
+    # pass of the engine. Returns a result for each operation, in order.
+    #
+    #   plugin = indigo.plugins["com.pennypacker.indigoplugin.senseme"]
+    #   results = plugin.executeAction("batchCommands", props = { "operations" :
+    #       [ [ "Office", "speed", 3 ], [ "Hall", "light", False ] ] }, waitUntilDone = True)
+    def batchCommands(self, action):
+        operations = action.props.get('operations', [])
+        results = indigo.List()
+        commands = []
+
+        try:
+            if isinstance(operations, basestring):
+                operations = json.loads(operations)
+        except ValueError as e:
+            self.errorLog("invalid batch of operations: %s" % ( str(e) ))
+            return results
+
+        for operation in operations:
+            result = indigo.Dict()
+            try:
+                device, attribute, value = operation
+                result['device'] = device
+                result['attribute'] = attribute
+                found = self.batchCommand(device, attribute, value)
+            except (TypeError, ValueError):
+                found = ( "operation must be ( device, attribute, value )", [] )
+
+            error, batch = found
+            result['ok'] = error == None
+            if error != None:
+                result['error'] = error
+                self.DebugMsg("batch operation %s failed: %s", operation, error)
+            commands.extend(batch)
+            results.append(result)
+
+        self.engine.sendCommands(commands)
+
+        return results
+
+    ########################################
+    # Returns ( error, [ commands for the engine ] ) for one batch operation
+    def batchCommand(self, device, attribute, value):
+        attr = BATCH_ATTRIBUTES.get(attribute)
+        if attr == None:
+            return ( "unknown attribute '%s'" % ( attribute ), [] )
+
+        try:
+            dev = indigo.devices[device]
+        except (KeyError, ValueError):
+            return ( "no such device '%s'" % ( device ), [] )
+
+        if dev.deviceTypeId == 'SenseME_group':
+            fans = self.groupFans(dev)
+        elif dev.id in self.allfans:
+            fans = [ self.allfans[dev.id] ]
+        else:
+            return ( "'%s' isn't a running SenseME fan or group" % ( dev.name ), [] )
+
+        if attr.values == ON_OFF:
+            value = onOffValue(value)
+            if value == None:
+                return ( "%s must be true or false" % ( attribute ), [] )
+        elif attr.values != None:
+            value = str(value).upper()
+            if value not in attr.values:
+                return ( "%s must be one of %s" % ( attribute, ', '.join(attr.values) ), [] )
+        else:
+            valid = self.validateActionConfigUi(indigo.Dict({ attr.field : str(value) }), attr.typeId, dev.id)
+            if valid != True:
+                return ( valid[2][attr.field], [] )
+            value = int(value)
+
+        if attribute == 'direction':
+            moving = [ fan.dev.name for fan in fans if fan.fan_level != 0 ]
+            if moving:
+                return ( "unable to set fan direction while fan is in motion: %s" % ( ', '.join(moving) ), [] )
+
+        cmd = attr.command % ( value )
+        return ( None, [ self.fanCommand(fan.dev, cmd, attr.coalesceKey) for fan in fans ] )
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+    ########################################
+    def setFanLightOn(self, action):
+        self.sendFanCommand(indigo.devices[action.deviceId], "LIGHT;PWR;ON")
+
+    ########################################
+    def setFanLightOff(self, action):
+        self.sendFanCommand(indigo.devices[action.deviceId], "LIGHT;PWR;OFF")
 
     ########################################
     def setFanLightBrightness(self, action):
@@ -590,18 +2752,13 @@ class Plugin(indigo.PluginBase):
 
         lightLevel = action.props.get("lightLevel")
 
-        self.DebugMsg(u"set brightness to %s" % (lightLevel))
-
-        fanName = dev.pluginProps['fanName']
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;LIGHT;LEVEL;SET;%s>" % (fanName, lightLevel)
+        self.DebugMsg(u"set brightness to %s", lightLevel)
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(dev, "LIGHT;LEVEL;SET;%s" % ( lightLevel ), "LIGHT;LEVEL")
 
     ########################################
     def validateActionConfigUi(self, valuesDict, typeId, deviceId):
-        self.DebugMsg(u"validating config for %s:%s" % (deviceId, typeId))
+        self.DebugMsg(u"validating config for %s:%s", deviceId, typeId)
         if typeId == 'fanLightBrightness':
             try:
                 i = int(valuesDict['lightLevel'])
@@ -694,363 +2851,121 @@ class Plugin(indigo.PluginBase):
         fanIP = dev.pluginProps['fanIP']
         cmd = action.props.get("cmd")
         if cmd:
-            self.DebugMsg(u"sending command %s to %s" % (cmd, fanIP))
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.sendto(cmd + '\n', (fanIP, 31415))
+            self.FanDebugMsg(dev.id, u"sending command %s to %s", cmd, fanIP)
+            self.metrics.commands[dev.id] += 1
+            self.engine.sendCommand(dev.id, fanIP, encodeMessage(cmd + '\n'))
 
     ########################################
     def setFanSpeed(self, action):
         dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
 
         speed = action.props.get("speed")
 
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;SPD;SET;%s>" % ( f, speed )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(dev, "FAN;SPD;SET;%s" % ( speed ), "FAN;SPD")
 
     ########################################
     def setFanOn(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;PWR;ON>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "FAN;PWR;ON")
 
     ########################################
     def setFanOff(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;PWR;OFF>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "FAN;PWR;OFF")
 
     ########################################
     def setFanMotionSensorOff(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;AUTO;OFF>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "FAN;AUTO;OFF")
 
     ########################################
     def setFanMotionSensorOn(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;AUTO;ON>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "FAN;AUTO;ON")
 
     ########################################
     def setLightMotionSensorOff(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;LIGHT;AUTO;OFF>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "LIGHT;AUTO;OFF")
 
     ########################################
     def setLightMotionSensorOn(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;LIGHT;AUTO;ON>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "LIGHT;AUTO;ON")
 
     ########################################
     def enableFanSmartHeating(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;SMARTMODE;STATE;SET;HEATING>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "SMARTMODE;STATE;SET;HEATING")
 
     ########################################
     def enableFanSmartCooling(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;SMARTMODE;STATE;SET;COOLING>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "SMARTMODE;STATE;SET;COOLING")
 
     ########################################
     def disableFanSmartMode(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;SMARTMODE;STATE;SET;OFF>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "SMARTMODE;STATE;SET;OFF")
 
     ########################################
     def setFanSmartModeMinSpeed(self, action):
         dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
 
         speed = action.props.get("speed")
 
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;LEARN;MINSPEED;SET;%d>" % ( f, int(speed) )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(dev, "LEARN;MINSPEED;SET;%d" % ( int(speed) ), "LEARN;MINSPEED")
 
     ########################################
     def setFanSmartModeMaxSpeed(self, action):
         dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
 
         speed = action.props.get("speed")
 
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;LEARN;MAXSPEED;SET;%s>" % ( f, speed )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(dev, "LEARN;MAXSPEED;SET;%s" % ( speed ), "LEARN;MAXSPEED")
 
     ########################################
     def setFanWhooshModeOn(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;WHOOSH;ON>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "FAN;WHOOSH;ON")
 
     ########################################
     def setFanWhooshModeOff(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
+        self.sendFanCommand(indigo.devices[action.deviceId], "FAN;WHOOSH;OFF")
 
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;WHOOSH;OFF>" % ( f )
+    ########################################
+    def setFanDirection(self, dev, direction):
+        isGroup = dev.deviceTypeId == 'SenseME_group'
+        if isGroup:
+            fans = self.groupFans(dev)
+        else:
+            fans = [ self.allfans[dev.id] ]
 
-        self.DebugMsg("Sending %s" % ( msg ))
+        commands = []
+        for fan in fans:
+            if fan.fan_level != 0:
+                if isGroup:
+                    indigo.server.log("unable to set %s direction while fan is in motion" % ( fan.dev.name ), isError=True)
+                else:
+                    indigo.server.log("unable to set fan direction while fan is in motion", isError=True)
+                continue
+            commands.append(self.fanCommand(fan.dev, "FAN;DIR;SET;%s" % ( direction )))
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.engine.sendCommands(commands)
 
     ########################################
     def setFanDirectionForward(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        if f['fan_level'] != '0':
-            indigo.server.log("unable to set fan direction while fan is in motion", isError=True)
-            return
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;DIR;SET;FWD>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.setFanDirection(indigo.devices[action.deviceId], "FWD")
 
     ########################################
     def setFanDirectionReverse(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        if f['fan_level'] != '0':
-            indigo.server.log("unable to set fan direction while fan is in motion", isError=True)
-            return
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;FAN;DIR;SET;REV>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.setFanDirection(indigo.devices[action.deviceId], "REV")
 
     ########################################
     def setFanIndicatorsOn(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;DEVICE;INDICATORS;ON>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "DEVICE;INDICATORS;ON")
 
     ########################################
     def setFanIndicatorsOff(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;DEVICE;INDICATORS;OFF>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "DEVICE;INDICATORS;OFF")
 
     ########################################
     def setFanBeepOn(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;DEVICE;BEEPER;ON>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "DEVICE;BEEPER;ON")
 
     ########################################
     def setFanBeepOff(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;DEVICE;BEEPER;OFF>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "DEVICE;BEEPER;OFF")
 
     ########################################
     def setFanSmartCoolingIdealTemp(self, action):
@@ -1064,14 +2979,9 @@ class Plugin(indigo.PluginBase):
         else:
             newTemp = int((float((int(temp) - 32) * 5) / 9) * 100)
 
-        self.DebugMsg(u"set cooling temperature to %s %s (%s)" % (str(temp), tempUnits, str(newTemp)))
-
-        fanName = dev.pluginProps['fanName']
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;LEARN;ZEROTEMP;SET;%s>" % (fanName, str(newTemp))
+        self.DebugMsg(u"set cooling temperature to %s %s (%s)", temp, tempUnits, newTemp)
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(dev, "LEARN;ZEROTEMP;SET;%s" % ( str(newTemp) ), "LEARN;ZEROTEMP")
 
     ########################################
     def setFanSmartSleepIdealTemp(self, action):
@@ -1085,45 +2995,14 @@ class Plugin(indigo.PluginBase):
         else:
             newTemp = int((float((int(temp) - 32) * 5) / 9) * 100)
 
-        self.DebugMsg(u"set sleep temperature to %s %s (%s)" % (str(temp), tempUnits, str(newTemp)))
+        self.DebugMsg(u"set sleep temperature to %s %s (%s)", temp, tempUnits, newTemp)
 
-        fanName = dev.pluginProps['fanName']
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;SMARTSLEEP;IDEALTEMP;SET;%s>" % (fanName, str(newTemp))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(dev, "SMARTSLEEP;IDEALTEMP;SET;%s" % ( str(newTemp) ), "SMARTSLEEP;IDEALTEMP")
 
     ########################################
     def setFanSleepModeOn(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;SLEEP;STATE;ON>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "SLEEP;STATE;ON")
 
     ########################################
     def setFanSleepModeOff(self, action):
-        dev = indigo.devices[action.deviceId]
-        fan = self.allfans[dev.id]
-
-        f = fan['MAC']
-        if f == '':
-            f = dev.pluginProps['fanName']
-
-        fanIP = dev.pluginProps['fanIP']
-        msg = "<%s;SLEEP;STATE;OFF>" % ( f )
-
-        self.DebugMsg("Sending %s" % ( msg ))
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (fanIP, 31415))
+        self.sendFanCommand(indigo.devices[action.deviceId], "SLEEP;STATE;OFF")
@@ -0,0 +1,271 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks for the plugin's message pipeline, run outside of Indigo using
+# the stub indigo module in tools/stubs. Run it with the same Python as the
+# Indigo server (2.7):
+#
+#     python tools/bench/bench.py > results.jsonl
+#     python tools/bench/bench.py --compare results.jsonl
+#
+# Each benchmark is run over each corpus in tools/bench/corpus, which hold
+# fan traffic as it is read from the sockets, one read per line in the form
+# "fan name<TAB>data". Lines starting with # are comments.
+#
+#   decode      splitting the data read from each fan into messages
+#   dispatch    handling the messages as the dispatcher does, batch by batch,
+#               up to and including the state updates sent to the server
+#   status      recomputing the device status string and image
+#   end_to_end  decoding, queueing on fan_queue and dispatching on a separate
+#               thread, as between the engine and runConcurrentThread
+#
+# Each run goes through the corpus --scale times over, so that it takes long
+# enough to time. Results are written as one JSON object per line, with the
+# best time of --repeat runs. --compare reads earlier results and shows the
+# change in throughput for each benchmark. Timings on a busy machine can vary
+# by 20% or more between runs, so raise --repeat before reading much into
+# small differences.
+
+import os
+import sys
+import time
+import json
+import glob
+import platform
+import argparse
+import threading
+import subprocess
+
+TOOLS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(TOOLS)
+PLUGIN_DIR = os.path.join(ROOT, 'SenseME.indigoPlugin', 'Contents', 'Server Plugin')
+CORPUS_DIR = os.path.join(TOOLS, 'bench', 'corpus')
+
+sys.path.insert(0, os.path.join(TOOLS, 'stubs'))
+sys.path.insert(0, PLUGIN_DIR)
+
+import indigo
+import plugin
+
+################################################################################
+# Returns [ ( fan name, data ) ] for each read in a corpus file
+def loadCorpus(path):
+    reads = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            name, data = line.split('\t', 1)
+            reads.append(( name, data ))
+    return reads
+
+def fanNames(reads):
+    return sorted(set(name for name, data in reads))
+
+# Returns [ ( fan name, message ) ] in the order they'd be decoded
+def decodeAll(reads):
+    decoders = {}
+    frames = []
+    for name, data in reads:
+        decoder = decoders.setdefault(name, plugin.FrameDecoder())
+        for frame in decoder.feed(data):
+            frames.append(( name, frame ))
+    return frames
+
+################################################################################
+# A plugin with a started device for each fan in the corpus. The connection
+# engine isn't started, so nothing goes near the network.
+class Harness(object):
+    def __init__(self, names):
+        indigo.server.quiet = True
+        indigo.devices.clear()
+        self.plugin = plugin.Plugin('org.pennypacker.SenseME', 'SenseME', 'bench', indigo.Dict({ 'debug': False, 'timeoutValue': '0' }))
+        self.devIDs = {}
+
+        for i, name in enumerate(names):
+            dev = indigo.Device(1000 + i, name, 'SenseME_fan', {
+                'fanName': name, 'fanIP': '127.0.1.%d' % ( i + 1 ), 'fanTempUnits': 'F', 'fanMAC': '' })
+            indigo.devices[dev.id] = dev
+            self.plugin.deviceStartComm(dev)
+            self.devIDs[name] = dev.id
+
+    def fan(self, name):
+        return self.plugin.allfans[self.devIDs[name]]
+
+    # Forget what the fans have reported so every run starts the same way
+    def reset(self):
+        for fan in self.plugin.allfans.values():
+            fan.reset()
+            fan.stateImage = None
+            fan.pending = {}
+
+################################################################################
+def benchDecode(harness, reads, frames):
+    start = time.time()
+    decodeAll(reads)
+    return time.time() - start, len(frames), {}
+
+def benchDispatch(harness, reads, frames):
+    harness.reset()
+    now = time.time()
+    messages = [ ( plugin.MSG_FAN, harness.devIDs[name], ( frame, now ) ) for name, frame in frames ]
+    dispatch = harness.plugin.dispatchMessages
+    batch = plugin.DISPATCH_BATCH
+
+    start = time.time()
+    for i in range(0, len(messages), batch):
+        dispatch(messages[i:i + batch])
+    return time.time() - start, len(messages), {}
+
+def benchStatus(harness, reads, frames):
+    harness.reset()
+    for name, frame in frames:
+        harness.plugin.processFanMessage(harness.fan(name), frame)
+    fans = [ harness.fan(name) for name, frame in frames ]
+    for fan in fans:
+        if fan.fan == None:
+            fan.fan = fan.light = False
+            fan.fan_level = fan.light_level = 0
+    update = harness.plugin.updateStatusString
+
+    # Alternate the speed now and then so some calls change the status
+    start = time.time()
+    for i, fan in enumerate(fans):
+        if i % 8 == 0:
+            fan.fan_level = (fan.fan_level + 1) % 8
+        update(fan)
+    return time.time() - start, len(fans), {}
+
+def benchEndToEnd(harness, reads, frames):
+    harness.reset()
+    p = harness.plugin
+    q = plugin.fan_queue
+    done = threading.Event()
+    dispatched = [ 0 ]
+    dispatch = p.dispatchMessages
+
+    # The last message queued is a marker, seen once everything before it has
+    # been dispatched
+    def dispatchMessages(batch):
+        dispatch(batch)
+        dispatched[0] += len([ msg for msg in batch if msg[0] == plugin.MSG_FAN ])
+        if batch[-1][1] == 'done':
+            done.set()
+    p.dispatchMessages = dispatchMessages
+    p.stopThread = False
+    thread = threading.Thread(target = p.runConcurrentThread)
+    thread.daemon = True
+    thread.start()
+
+    devIDs = harness.devIDs
+    decoders = dict(( name, plugin.FrameDecoder() ) for name in devIDs)
+
+    start = time.time()
+    for name, data in reads:
+        now = time.time()
+        devID = devIDs[name]
+        for frame in decoders[name].feed(data):
+            key, ordered = plugin.fanMessageKey(frame)
+            q.put(( plugin.MSG_FAN, devID, ( frame, now ) ), key, ordered)
+    q.put(( plugin.MSG_WAKE, 'done', None ))
+    done.wait()
+    elapsed = time.time() - start
+
+    p.stopConcurrentThread()
+    thread.join()
+    del p.dispatchMessages
+
+    # Messages superseded in the queue never reach the dispatcher
+    return elapsed, len(frames), { 'dispatched': dispatched[0] }
+
+BENCHMARKS = [
+    ( 'decode',     benchDecode ),
+    ( 'dispatch',   benchDispatch ),
+    ( 'status',     benchStatus ),
+    ( 'end_to_end', benchEndToEnd ),
+]
+
+################################################################################
+def gitRevision():
+    try:
+        return subprocess.check_output([ 'git', 'rev-parse', '--short', 'HEAD' ], cwd = ROOT, stderr = open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    revision = gitRevision()
+    corpora = sorted(glob.glob(os.path.join(CORPUS_DIR, '*.txt')))
+
+    for path in corpora:
+        corpus = os.path.splitext(os.path.basename(path))[0]
+        if args.corpus and corpus not in args.corpus:
+            continue
+
+        reads = loadCorpus(path)
+        harness = Harness(fanNames(reads))
+        reads = reads * args.scale
+        frames = decodeAll(reads)
+
+        for name, fn in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+
+            best = None
+            for i in range(args.repeat):
+                elapsed, ops, extra = fn(harness, reads, frames)
+                if best == None or elapsed < best[0]:
+                    best = ( elapsed, ops, extra )
+
+            elapsed, ops, extra = best
+            result = {
+                'benchmark': name,
+                'corpus': corpus,
+                'ops': ops,
+                'seconds': round(elapsed, 6),
+                'ops_per_sec': round(ops / elapsed, 1) if elapsed > 0 else None,
+                'repeat': args.repeat,
+                'scale': args.scale,
+                'python': platform.python_version(),
+                'revision': revision,
+            }
+            result.update(extra)
+            yield result
+
+def compare(baselinePath, results):
+    baseline = {}
+    with open(baselinePath) as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                baseline[( r['benchmark'], r['corpus'] )] = r
+
+    sys.stderr.write("%-12s %-14s %14s %14s %8s\n" % ( 'benchmark', 'corpus', 'baseline/s', 'now/s', 'change' ))
+    for r in results:
+        old = baseline.get(( r['benchmark'], r['corpus'] ))
+        if old == None or not old['ops_per_sec'] or not r['ops_per_sec']:
+            sys.stderr.write("%-12s %-14s %14s %14s\n" % ( r['benchmark'], r['corpus'], '-', r['ops_per_sec'] ))
+            continue
+        change = (r['ops_per_sec'] / old['ops_per_sec'] - 1) * 100
+        sys.stderr.write("%-12s %-14s %14.1f %14.1f %+7.1f%%\n" % ( r['benchmark'], r['corpus'], old['ops_per_sec'], r['ops_per_sec'], change ))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the SenseME plugin's message pipeline")
+    parser.add_argument('--repeat', type = int, default = 5, help = "runs of each benchmark, the best is reported (default 5)")
+    parser.add_argument('--scale', type = int, default = 20, help = "times through the corpus in each run (default 20)")
+    parser.add_argument('--only', action = 'append', help = "run only this benchmark (may be repeated)")
+    parser.add_argument('--corpus', action = 'append', help = "use only this corpus (may be repeated)")
+    parser.add_argument('--compare', metavar = 'FILE', help = "compare with results saved from an earlier run")
+    args = parser.parse_args()
+
+    results = []
+    for result in run(args):
+        results.append(result)
+        sys.stdout.write(json.dumps(result, sort_keys = True) + '\n')
+        sys.stdout.flush()
+
+    if args.compare:
+        compare(args.compare, results)
+
+if __name__ == '__main__':
+    main()
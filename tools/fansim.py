@@ -0,0 +1,555 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Simulates any number of SenseME fans on the local machine so the plugin
+# can be exercised without real Haiku fans.
+#
+# Each simulated fan gets its own loopback address (127.0.1.1, 127.0.1.2,
+# ...) and listens there for TCP connections and UDP datagrams on the fan
+# port, just like a real fan. It answers GETALL, DEVICE;ID;GET and the other
+# GET requests, applies the SET commands the plugin's actions send and
+# reports the resulting state changes to every connected client. It can also
+# produce unsolicited motion and speed changes, and drop its connections or
+# go silent, either at random or on demand.
+#
+# Linux routes the whole of 127.0.0.0/8 to the loopback interface. On macOS
+# each address has to be added first, e.g.
+#
+#     sudo ifconfig lo0 alias 127.0.1.1 up
+#
+# Example, 200 fans with motion changing about once a minute per fan:
+#
+#     python tools/fansim.py --count 200 --motion-rate 0.016
+#
+# Then point SenseME devices at Fan1 / 127.0.1.1 and so on. Commands can be
+# typed on stdin while it runs; type "help" for the list.
+
+import sys
+import errno
+import socket
+import select
+import random
+import time
+import argparse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+FAN_PORT = 31415
+
+# Initial state of every simulated fan. Values are reported as
+# (name;key;value).
+INITIAL_STATE = [
+    ( 'FAN;PWR',              'OFF' ),
+    ( 'FAN;SPD;CURR',         '0' ),
+    ( 'FAN;SPD;ACTUAL',       '0' ),
+    ( 'FAN;AUTO',             'OFF' ),
+    ( 'FAN;DIR',              'FWD' ),
+    ( 'FAN;WHOOSH;STATUS',    'OFF' ),
+    ( 'LIGHT;PWR',            'OFF' ),
+    ( 'LIGHT;LEVEL;ACTUAL',   '0' ),
+    ( 'LIGHT;AUTO',           'OFF' ),
+    ( 'SMARTMODE;STATE',      'OFF' ),
+    ( 'SMARTMODE;ACTUAL',     'OFF' ),
+    ( 'DEVICE;BEEPER',        'ON' ),
+    ( 'DEVICE;INDICATORS',    'ON' ),
+    ( 'LEARN;MINSPEED',       '1' ),
+    ( 'LEARN;MAXSPEED',       '7' ),
+    ( 'LEARN;ZEROTEMP',       '2500' ),
+    ( 'SMARTSLEEP;IDEALTEMP', '2200' ),
+    ( 'SLEEP;STATE',          'OFF' ),
+    ( 'SNSROCC;STATUS',       'UNOCCUPIED' ),
+]
+
+COMMANDS_HELP = """commands (NAME is a fan name or "all"):
+  drop NAME            close the fan's connections
+  silent NAME [SECS]   ignore requests and stop reporting, keeping connections open
+  wake NAME            end silence
+  down NAME            stop accepting connections, closing existing ones
+  up NAME              accept connections again
+  motion NAME          toggle the motion sensor
+  speed NAME N         change the fan speed as if from the remote
+  stats                show message counts
+  quit"""
+
+################################################################################
+def ipToInt(ip):
+    a, b, c, d = [ int(x) for x in ip.split('.') ]
+    return (a << 24) | (b << 16) | (c << 8) | d
+
+def intToIP(n):
+    return "%d.%d.%d.%d" % ( (n >> 24) & 255, (n >> 16) & 255, (n >> 8) & 255, n & 255 )
+
+################################################################################
+# A connection from the plugin to one simulated fan
+class SimClient(object):
+    def __init__(self, fan, sock):
+        self.fan = fan
+        self.sock = sock
+        self.inbuf = ''
+        self.outbuf = ''
+
+################################################################################
+class SimFan(object):
+    def __init__(self, sim, index, name, mac, ip):
+        self.sim = sim
+        self.index = index
+        self.name = name
+        self.mac = mac
+        self.ip = ip
+        self.state = dict(INITIAL_STATE)
+        self.lastLightLevel = '16'
+        self.listener = None
+        self.udp = None
+        self.clients = []
+        self.silentUntil = 0
+        self.received = 0
+        self.sent = 0
+        self.drops = 0
+
+    def frame(self, key, value):
+        return "(%s;%s;%s)" % ( self.name, key, value )
+
+    # Handles one "<...>" request and returns the replies for whoever sent it
+    # as a string. State changes are also reported to every client.
+    def handle(self, request):
+        params = request.split(';')
+        if len(params) < 2 or params[0] not in (self.name, self.mac, 'ALL'):
+            return ''
+
+        self.received += 1
+        params = params[1:]
+        cmd = ';'.join(params)
+
+        if cmd == 'GETALL':
+            return ''.join(self.frame(key, self.state[key]) for key, initial in INITIAL_STATE) + self.identity()
+
+        if cmd == 'DEVICE;ID;GET':
+            return self.identity()
+
+        if params[-1] == 'GET':
+            key = ';'.join(params[:-1])
+            if key in self.state:
+                return self.frame(key, self.state[key])
+            return self.frame('ERROR', 'INVALID_REQUEST')
+
+        updates = self.apply(params)
+        if updates == None:
+            return self.frame('ERROR', 'INVALID_REQUEST')
+
+        self.report(updates)
+        return ''
+
+    def identity(self):
+        return self.frame('DEVICE;ID', "%s;FAN,HAIKU" % ( self.mac ))
+
+    # Works out the state changes a command causes. Returns None if the
+    # command isn't understood.
+    def apply(self, params):
+        if len(params) >= 3 and params[-2] == 'SET':
+            key = ';'.join(params[:-2])
+            value = params[-1]
+        elif len(params) >= 2 and params[-1] in ('ON', 'OFF'):
+            key = ';'.join(params[:-1])
+            value = params[-1]
+        else:
+            return None
+
+        if key == 'FAN;SPD':
+            return [ ( 'FAN;SPD;CURR', value ), ( 'FAN;SPD;ACTUAL', value ),
+                     ( 'FAN;PWR', 'ON' if value != '0' else 'OFF' ) ]
+        if key == 'FAN;PWR':
+            speed = self.state['FAN;SPD;CURR']
+            if value == 'ON' and speed == '0':
+                speed = '1'
+            return [ ( 'FAN;PWR', value ), ( 'FAN;SPD;CURR', speed ),
+                     ( 'FAN;SPD;ACTUAL', speed if value == 'ON' else '0' ) ]
+        if key == 'LIGHT;LEVEL':
+            if value != '0':
+                self.lastLightLevel = value
+            return [ ( 'LIGHT;LEVEL;ACTUAL', value ), ( 'LIGHT;PWR', 'ON' if value != '0' else 'OFF' ) ]
+        if key == 'LIGHT;PWR':
+            return [ ( 'LIGHT;PWR', value ), ( 'LIGHT;LEVEL;ACTUAL', self.lastLightLevel if value == 'ON' else '0' ) ]
+        if key == 'FAN;WHOOSH':
+            return [ ( 'FAN;WHOOSH;STATUS', value ) ]
+        if key == 'SMARTMODE;STATE':
+            return [ ( 'SMARTMODE;STATE', value ), ( 'SMARTMODE;ACTUAL', value ) ]
+        if key in self.state:
+            return [ ( key, value ) ]
+        return None
+
+    # Applies state changes and sends them to every client. Like a real fan,
+    # a change is reported even if the value is the same as before.
+    def report(self, updates):
+        data = ''
+        for key, value in updates:
+            self.state[key] = value
+            data += self.frame(key, value)
+        for client in self.clients:
+            self.sim.send(client, data)
+
+    def silent(self):
+        return time.time() < self.silentUntil
+
+    def toggleMotion(self):
+        if self.state['SNSROCC;STATUS'] == 'OCCUPIED':
+            value = 'UNOCCUPIED'
+        else:
+            value = 'OCCUPIED'
+        self.report([ ( 'SNSROCC;STATUS', value ) ])
+
+    def setSpeed(self, speed):
+        self.report(self.apply([ 'FAN', 'SPD', 'SET', str(speed) ]))
+
+################################################################################
+# Waits on the sockets with poll() where it's available, since select() is
+# limited to file descriptors below 1024
+class Waiter(object):
+    def __init__(self):
+        self.poll = select.poll() if hasattr(select, 'poll') else None
+        self.fds = {}
+
+    def add(self, fd, write = False):
+        self.fds[fd] = write
+        if self.poll != None:
+            self.poll.register(fd, select.POLLIN | (select.POLLOUT if write else 0))
+
+    def modify(self, fd, write):
+        if self.fds.get(fd) != write:
+            self.add(fd, write)
+
+    def remove(self, fd):
+        del self.fds[fd]
+        if self.poll != None:
+            self.poll.unregister(fd)
+
+    # Returns lists of readable and writable file descriptors
+    def wait(self, timeout):
+        if self.poll != None:
+            ready = self.poll.poll(timeout * 1000)
+            readable = [ fd for fd, events in ready if events & ~select.POLLOUT ]
+            writable = [ fd for fd, events in ready if events & select.POLLOUT ]
+            return readable, writable
+
+        writers = [ fd for fd, write in self.fds.items() if write ]
+        readable, writable, errors = select.select(list(self.fds.keys()), writers, [], timeout)
+        return readable, writable
+
+################################################################################
+# Runs all of the simulated fans from one event loop
+class Simulator(object):
+    def __init__(self, args):
+        self.args = args
+        self.fans = []
+        self.byName = {}
+        self.socks = {}
+        self.waiter = Waiter()
+        self.rng = random.Random(args.seed)
+        self.started = time.time()
+        self.running = True
+
+        base = ipToInt(args.base_ip)
+        for i in range(args.count):
+            fan = SimFan(self, i, "%s%d" % ( args.prefix, i + 1 ), "20:F8:5E:%02X:%02X:%02X" % ( (i >> 16) & 255, (i >> 8) & 255, i & 255 ), intToIP(base + i))
+            self.fans.append(fan)
+            self.byName[fan.name.lower()] = fan
+
+        # Each kind of random event, its rate per fan per second and what to
+        # do when it happens
+        self.events = [
+            ( args.motion_rate, lambda fan: fan.toggleMotion() ),
+            ( args.speed_rate, lambda fan: fan.setSpeed(self.rng.randint(0, 7)) ),
+            ( args.drop_rate, lambda fan: self.drop(fan) ),
+            ( args.silent_rate, lambda fan: self.silence(fan, args.silent_time) ),
+        ]
+        self.due = []
+        for rate, action in self.events:
+            self.due.append([ self.nextTime(rate) for fan in self.fans ])
+
+    def nextTime(self, rate):
+        if rate <= 0:
+            return None
+        return time.time() + self.rng.expovariate(rate)
+
+    ########################################
+    def up(self, fan):
+        if fan.listener != None:
+            return
+
+        fan.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        fan.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        fan.listener.bind((fan.ip, self.args.port))
+        fan.listener.listen(16)
+        fan.listener.setblocking(0)
+        self.watch(fan.listener, ( 'listen', fan ))
+
+        if fan.udp == None:
+            fan.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            fan.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            fan.udp.bind((fan.ip, self.args.port))
+            fan.udp.setblocking(0)
+            self.watch(fan.udp, ( 'udp', fan ))
+
+    def down(self, fan):
+        self.drop(fan)
+        if fan.listener != None:
+            self.unwatch(fan.listener)
+            fan.listener.close()
+            fan.listener = None
+
+    def drop(self, fan):
+        for client in list(fan.clients):
+            self.close(client)
+        fan.drops += 1
+
+    def silence(self, fan, seconds):
+        fan.silentUntil = time.time() + seconds
+
+    def close(self, client):
+        fan = client.fan
+        if client in fan.clients:
+            fan.clients.remove(client)
+            self.unwatch(client.sock)
+            client.sock.close()
+
+    def watch(self, sock, entry):
+        self.socks[sock.fileno()] = entry
+        self.waiter.add(sock.fileno())
+
+    def unwatch(self, sock):
+        del self.socks[sock.fileno()]
+        self.waiter.remove(sock.fileno())
+
+    ########################################
+    def send(self, client, data):
+        if client.fan.silent():
+            return
+        client.fan.sent += data.count('(')
+        client.outbuf += data
+        self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.outbuf.encode('ascii'))
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.close(client)
+            return
+        client.outbuf = client.outbuf[sent:]
+        self.waiter.modify(client.sock.fileno(), client.outbuf != '')
+
+    def accept(self, fan):
+        try:
+            sock, addr = fan.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        client = SimClient(fan, sock)
+        fan.clients.append(client)
+        self.watch(sock, ( 'client', client ))
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.close(client)
+            return
+
+        if client.fan.silent():
+            return
+
+        client.inbuf += data.decode('ascii', 'replace')
+        while True:
+            start = client.inbuf.find('<')
+            end = client.inbuf.find('>', start + 1)
+            if start < 0 or end < 0:
+                break
+            reply = client.fan.handle(client.inbuf[start + 1:end])
+            client.inbuf = client.inbuf[end + 1:]
+            if reply:
+                self.send(client, reply)
+
+        # Don't let garbage without any requests in it build up
+        if len(client.inbuf) > 4096:
+            client.inbuf = ''
+
+    # UDP requests are applied the same way, and GET replies go back to the
+    # sender. State changes are reported to the TCP clients as usual.
+    def readDatagram(self, fan):
+        try:
+            data, addr = fan.udp.recvfrom(4096)
+        except socket.error:
+            return
+        if fan.silent():
+            return
+
+        for request in data.decode('ascii', 'replace').split('>'):
+            start = request.find('<')
+            if start < 0:
+                continue
+            reply = fan.handle(request[start + 1:])
+            if reply:
+                fan.sent += reply.count('(')
+                try:
+                    fan.udp.sendto(reply.encode('ascii'), addr)
+                except socket.error:
+                    pass
+
+    ########################################
+    def runEvents(self):
+        now = time.time()
+        due = now + 1
+        for e, ( rate, action ) in enumerate(self.events):
+            times = self.due[e]
+            for i, fan in enumerate(self.fans):
+                t = times[i]
+                if t == None:
+                    continue
+                if now >= t:
+                    if fan.listener != None and not fan.silent():
+                        action(fan)
+                    t = times[i] = self.nextTime(rate)
+                due = min(due, t)
+        return max(0, due - now)
+
+    def fansNamed(self, name):
+        if name == 'all':
+            return self.fans
+        fan = self.byName.get(name.lower())
+        if fan == None:
+            print("no fan named %s" % ( name ))
+            return []
+        return [ fan ]
+
+    def command(self, line):
+        words = line.split()
+        if not words:
+            return
+        cmd = words[0]
+
+        if cmd == 'quit':
+            self.running = False
+        elif cmd == 'stats':
+            self.stats()
+        elif cmd in ('drop', 'silent', 'wake', 'down', 'up', 'motion', 'speed') and len(words) >= 2:
+            for fan in self.fansNamed(words[1]):
+                if cmd == 'drop':
+                    self.drop(fan)
+                elif cmd == 'silent':
+                    self.silence(fan, float(words[2]) if len(words) > 2 else 1e9)
+                elif cmd == 'wake':
+                    fan.silentUntil = 0
+                elif cmd == 'down':
+                    self.down(fan)
+                elif cmd == 'up':
+                    self.up(fan)
+                elif cmd == 'motion':
+                    fan.toggleMotion()
+                elif cmd == 'speed' and len(words) > 2:
+                    fan.setSpeed(int(words[2]))
+        else:
+            print(COMMANDS_HELP)
+
+    def stats(self):
+        elapsed = max(1, time.time() - self.started)
+        received = sum(fan.received for fan in self.fans)
+        sent = sum(fan.sent for fan in self.fans)
+        clients = sum(len(fan.clients) for fan in self.fans)
+        print("%d fans, %d connections, %d requests (%.1f/s), %d messages sent (%.1f/s), %d drops" %
+            ( len(self.fans), clients, received, received / elapsed, sent, sent / elapsed, sum(fan.drops for fan in self.fans) ))
+        if self.args.verbose:
+            for fan in self.fans:
+                print("  %-10s %-15s %d connections, %d requests, %d sent%s" %
+                    ( fan.name, fan.ip, len(fan.clients), fan.received, fan.sent, " (silent)" if fan.silent() else "" ))
+
+    ########################################
+    def run(self):
+        # Each fan needs two sockets plus one per connection
+        if resource != None:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            wanted = len(self.fans) * 4 + 64
+            if soft != resource.RLIM_INFINITY and soft < wanted:
+                if hard != resource.RLIM_INFINITY:
+                    wanted = min(wanted, hard)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+        for fan in self.fans:
+            self.up(fan)
+
+        if self.args.stdin:
+            self.waiter.add(sys.stdin.fileno())
+
+        print("simulating %d fans on %s to %s port %d" % ( len(self.fans), self.fans[0].ip, self.fans[-1].ip, self.args.port ))
+        if self.args.stdin:
+            print('type "help" for commands')
+
+        while self.running:
+            timeout = self.runEvents()
+
+            try:
+                readable, writable = self.waiter.wait(timeout)
+            except (select.error, IOError, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in writable:
+                entry = self.socks.get(fd)
+                if entry != None and entry[0] == 'client':
+                    self.flush(entry[1])
+
+            for fd in readable:
+                if self.args.stdin and fd == sys.stdin.fileno():
+                    line = sys.stdin.readline()
+                    if not line:
+                        self.args.stdin = False
+                        self.waiter.remove(fd)
+                    else:
+                        self.command(line)
+                    continue
+
+                entry = self.socks.get(fd)
+                if entry == None:
+                    continue
+                kind, obj = entry
+                if kind == 'listen':
+                    self.accept(obj)
+                elif kind == 'udp':
+                    self.readDatagram(obj)
+                else:
+                    self.read(obj)
+
+        self.stats()
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(description = "Simulate SenseME fans on loopback addresses")
+    parser.add_argument('--count', type = int, default = 10, help = "number of fans (default 10)")
+    parser.add_argument('--base-ip', default = '127.0.1.1', help = "address of the first fan, the rest follow on (default 127.0.1.1)")
+    parser.add_argument('--port', type = int, default = FAN_PORT, help = "port to listen on (default %d)" % ( FAN_PORT ))
+    parser.add_argument('--prefix', default = 'Fan', help = "fan names are this followed by a number (default Fan)")
+    parser.add_argument('--motion-rate', type = float, default = 0, help = "motion sensor changes per fan per second")
+    parser.add_argument('--speed-rate', type = float, default = 0, help = "fan speed changes per fan per second")
+    parser.add_argument('--drop-rate', type = float, default = 0, help = "dropped connections per fan per second")
+    parser.add_argument('--silent-rate', type = float, default = 0, help = "silent spells per fan per second")
+    parser.add_argument('--silent-time', type = float, default = 30, help = "length of a silent spell in seconds (default 30)")
+    parser.add_argument('--seed', type = int, default = None, help = "random seed, for repeatable runs")
+    parser.add_argument('--no-stdin', dest = 'stdin', action = 'store_false', help = "don't read commands from stdin")
+    parser.add_argument('--verbose', action = 'store_true', help = "show per fan counts in stats")
+    args = parser.parse_args()
+
+    sim = Simulator(args)
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        sim.stats()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Plays back a fan traffic capture, made with the plugin's "Capture fan
+# traffic" setting, through the plugin's decoder and message handling, using
+# the stub indigo module in tools/stubs. Run it with the same Python as the
+# Indigo server (2.7):
+#
+#     python tools/replay.py Office-12345.cap
+#     python tools/replay.py --speed 10 --verbose Office-12345.cap
+#     python tools/replay.py --speed 0 --profile Office-12345.cap
+#
+# Files rotated out of the named capture (Office-12345.cap.1 and so on) are
+# played first, oldest first, unless --no-rotated is given. --speed sets how
+# much faster than real time to play back, with 0 meaning as fast as possible.
+
+import os
+import sys
+import time
+import argparse
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TOOLS)
+PLUGIN_DIR = os.path.join(ROOT, 'SenseME.indigoPlugin', 'Contents', 'Server Plugin')
+
+sys.path.insert(0, os.path.join(TOOLS, 'stubs'))
+sys.path.insert(0, PLUGIN_DIR)
+
+import indigo
+import plugin
+
+DEV_ID = 1
+
+################################################################################
+class Replay(object):
+    def __init__(self, args):
+        self.args = args
+        indigo.server.quiet = not args.verbose
+
+        self.plugin = plugin.Plugin('org.pennypacker.SenseME', 'SenseME', 'replay', indigo.Dict({
+            'debug': args.verbose, 'timeoutValue': '0' }))
+        self.plugin.debug = args.verbose
+
+        self.dev = indigo.Device(DEV_ID, 'Replay', 'SenseME_fan', {
+            'fanName': args.name, 'fanIP': '127.0.0.1', 'fanTempUnits': args.units, 'fanMAC': '' })
+        indigo.devices[DEV_ID] = self.dev
+        self.plugin.deviceStartComm(self.dev)
+
+        self.decoder = plugin.FrameDecoder()
+        self.reads = 0
+        self.bytes = 0
+        self.messages = 0
+        self.connections = 0
+        self.first = None
+        self.last = None
+
+    # Handle each read the way the engine and dispatcher do, one batch per
+    # read
+    def record(self, when, kind, data):
+        if kind == plugin.CAPTURE_CONNECTED:
+            self.connections += 1
+            self.decoder.reset()
+            if data == '1':
+                self.plugin.dispatchMessages([ ( plugin.MSG_REINIT, DEV_ID, "" ) ])
+            return
+
+        if kind != plugin.CAPTURE_RECEIVED:
+            return
+
+        self.reads += 1
+        self.bytes += len(data)
+        now = time.time()
+        batch = [ ( plugin.MSG_FAN, DEV_ID, ( frame, now ) ) for frame in self.decoder.feed(data) ]
+        self.messages += len(batch)
+        if batch:
+            self.plugin.dispatchMessages(batch)
+
+    def run(self, paths):
+        speed = self.args.speed
+        started = time.time()
+
+        for path in paths:
+            for when, kind, data in plugin.readCapture(path):
+                if self.first == None:
+                    self.first = when
+                self.last = when
+
+                if speed > 0:
+                    delay = started + (when - self.first) / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                self.record(when, kind, data)
+
+        return time.time() - started
+
+    def report(self, elapsed):
+        metrics = self.plugin.metrics
+        span = (self.last - self.first) if self.first != None else 0
+        print("%d connections, %d reads, %d bytes, %d messages over %.1f seconds of capture" %
+            ( self.connections, self.reads, self.bytes, self.messages, span ))
+        print("replayed in %.3f seconds, %.0f messages per second" %
+            ( elapsed, self.messages / elapsed if elapsed > 0 else 0 ))
+        print("%d parse failures, %d bytes discarded, %d server updates" %
+            ( metrics.parseFailures[DEV_ID], self.decoder.discarded, self.dev.updates ))
+        print("final states:")
+        for key in sorted(self.dev.states):
+            print("  %-18s %s" % ( key, self.dev.states[key] ))
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(description = "Play back captured fan traffic through the SenseME plugin")
+    parser.add_argument('capture', nargs = '+', help = "capture files to play, in order")
+    parser.add_argument('--speed', type = float, default = 1, help = "times faster than real time, 0 for as fast as possible (default 1)")
+    parser.add_argument('--no-rotated', dest = 'rotated', action = 'store_false', help = "don't play the files rotated out of each capture first")
+    parser.add_argument('--name', default = 'Replay', help = "fan name given to the device (default Replay)")
+    parser.add_argument('--units', default = 'F', choices = [ 'F', 'C' ], help = "temperature units of the device (default F)")
+    parser.add_argument('--verbose', action = 'store_true', help = "show the plugin's debug messages")
+    parser.add_argument('--profile', action = 'store_true', help = "profile the replay and show where the time went")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.capture:
+        if args.rotated:
+            found = plugin.captureFiles(path)
+            if not found:
+                parser.error("%s not found" % ( path ))
+            paths.extend(found)
+        else:
+            paths.append(path)
+
+    replay = Replay(args)
+
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        elapsed = profiler.runcall(replay.run, paths)
+        replay.report(elapsed)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    else:
+        replay.report(replay.run(paths))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+# A stand-in for the indigo module, just complete enough to load plugin.py
+# and drive it outside of the Indigo server, for the benchmarks and other
+# tools. Server calls are recorded or discarded rather than acted on.
+
+import os
+import tempfile
+import time
+
+class _StateImageSel(object):
+    FanOff = 'FanOff'
+    FanLow = 'FanLow'
+    FanMedium = 'FanMedium'
+    FanHigh = 'FanHigh'
+    Error = 'Error'
+
+kStateImageSel = _StateImageSel()
+
+class Dict(dict):
+    pass
+
+class List(list):
+    pass
+
+################################################################################
+class _Server(object):
+    def __init__(self):
+        self.folder = tempfile.mkdtemp(prefix = 'indigo-stub-')
+        os.makedirs(os.path.join(self.folder, 'Preferences', 'Plugins'))
+        self.quiet = False
+
+    def log(self, msg, type = None, isError = False):
+        if not self.quiet:
+            print(msg)
+
+    def getInstallFolderPath(self):
+        return self.folder
+
+server = _Server()
+
+################################################################################
+# A device that keeps its states in a dict and counts the server updates made
+class Device(object):
+    def __init__(self, id, name, deviceTypeId, pluginProps):
+        self.id = id
+        self.name = name
+        self.deviceTypeId = deviceTypeId
+        self.pluginProps = Dict(pluginProps)
+        self.states = {}
+        self.errorState = None
+        self.updates = 0
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+    def updateStateOnServer(self, key, value, triggerEvents = True, uiValue = None, clearErrorState = True, **kwargs):
+        self.updates += 1
+        self.states[key] = value
+        if clearErrorState:
+            self.errorState = None
+
+    def updateStatesOnServer(self, states, triggerEvents = True, clearErrorState = True, **kwargs):
+        self.updates += 1
+        for state in states:
+            self.states[state['key']] = state['value']
+        if clearErrorState:
+            self.errorState = None
+
+    def updateStateImageOnServer(self, image):
+        pass
+
+    def replacePluginPropsOnServer(self, props):
+        self.pluginProps = Dict(props)
+
+    def setErrorStateOnServer(self, error):
+        self.errorState = error
+
+class _Devices(dict):
+    def iter(self, filter = None):
+        return iter(list(self.values()))
+
+devices = _Devices()
+
+################################################################################
+class _Variable(object):
+    def __init__(self, name, value, folderId):
+        self.name = name
+        self.value = value
+        self.folderId = folderId
+
+class _Folder(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+class _Folders(dict):
+    def create(self, name):
+        self[name] = _Folder(len(self) + 1, name)
+        return self[name]
+
+class _Variables(dict):
+    def __init__(self):
+        dict.__init__(self)
+        self.folders = _Folders()
+        self.folder = self.folders
+
+variables = _Variables()
+
+class _VariableCommands(object):
+    def create(self, name, value = '', folder = 0):
+        variables[name] = _Variable(name, value, folder)
+        return variables[name]
+
+    def updateValue(self, name, value):
+        variables[name].value = value
+
+variable = _VariableCommands()
+
+################################################################################
+class PluginBase(object):
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.stopThread = False
+        self.debug = False
+
+    def __del__(self):
+        pass
+
+    def debugLog(self, msg):
+        if self.debug and not server.quiet:
+            print("debug: %s" % ( msg ))
+
+    def errorLog(self, msg):
+        print("error: %s" % ( msg ))
+
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread()
+        time.sleep(seconds)
+
+    def stopConcurrentThread(self):
+        self.stopThread = True